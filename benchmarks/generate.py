@@ -0,0 +1,104 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generators of synthetic snoopy logfiles and collation trees, for benchmarking."""
+
+import datetime
+import gzip
+import os
+import os.path
+import time
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+ARGS = ['-c', '-l', '--verbose', '/tmp/some file.txt', 'foo bar', '-o', 'out put', '/usr/share/man/man1/grep.1.gz', 'x', '--', '*.c']
+
+def make_binaries(root, n_binaries):
+    """Create n_binaries empty executables under root, some with spaces in their paths.
+
+    Returns their paths."""
+    paths = []
+    for i in range(n_binaries):
+        if i % 10 == 9:
+            dirpath = os.path.join(root, 'opt', 'some tool', 'bin')
+            filename = 'tool %03d' % i
+        else:
+            dirpath = os.path.join(root, 'usr', 'bin')
+            filename = 'prog%03d' % i
+        os.makedirs(dirpath, exist_ok=True)
+        path = os.path.join(dirpath, filename)
+        with open(path, 'w'):
+            pass
+        os.chmod(path, 0o755)
+        paths.append(path)
+    return paths
+
+def snoopy_line(dt, hostname, pid, uid, cwd, filename, cmdline):
+    return '%s %2d %02d:%02d:%02d %s snoopy[%d]: [uid:%d sid:%d tty:/dev/pts/%d cwd:%s filename:%s]: %s\n' % (
+        MONTHS[dt.month - 1], dt.day, dt.hour, dt.minute, dt.second, hostname,
+        pid, uid, pid - 7, pid % 10, cwd, filename, cmdline)
+
+def generate_logs(logdir, binaries, rng, start=datetime.date(2017, 12, 30), days=4, lines_per_day=10000, n_users=20, hostname='benchhost'):
+    """Write a gzipped snoopy-YYYYMMDD.gz logfile into logdir for each of days,
+    starting at start, which by default spans the Dec/Jan rollover.
+
+    As with logrotate's dateext, each logfile is named for the day after the
+    lines it contains.  Returns the total number of lines written."""
+    os.makedirs(logdir, exist_ok=True)
+    uids = [0] + [1000 + i for i in range(n_users - 1)]
+    n = 0
+    for day in range(days):
+        date = start + datetime.timedelta(days=day)
+        rotated = date + datetime.timedelta(days=1)
+        path = os.path.join(logdir, 'snoopy-%s.gz' % rotated.strftime('%Y%m%d'))
+        seconds = sorted(rng.randrange(86400) for i in range(lines_per_day))
+        with gzip.open(path, 'wb') as f:
+            for second in seconds:
+                dt = datetime.datetime(date.year, date.month, date.day) + datetime.timedelta(seconds=second)
+                binary = rng.choice(binaries)
+                if rng.random() < 0.1:
+                    # relative invocation
+                    cwd, filename = os.path.split(binary)
+                else:
+                    cwd, filename = '/home/user %d' % rng.randrange(n_users), binary
+                args = ' '.join(rng.choice(ARGS) for i in range(rng.randrange(5)))
+                cmdline = ('%s %s' % (filename, args)).rstrip()
+                f.write(snoopy_line(dt, hostname, rng.randrange(1000, 32768), rng.choice(uids), cwd, filename, cmdline).encode('utf-8'))
+        n += lines_per_day
+    return n
+
+def generate_collation_tree(collation_dir, classes, hosts, relpaths, rng, lines_per_file=1000, start=datetime.datetime(2018, 1, 1)):
+    """Write a collation tree as collated on each of hosts, for each of classes,
+    with a collated file for each relpath.  Returns the total bytes written."""
+    n_bytes = 0
+    t0 = time.mktime(start.timetuple())
+    for cls in classes:
+        for host in hosts:
+            for relpath in relpaths:
+                path = os.path.join(collation_dir, cls, host, relpath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                t = t0
+                lines = []
+                for i in range(lines_per_file):
+                    t += rng.randrange(60)
+                    lines.append('%s %s user%d /%s %s\n' % (
+                        time.strftime('%Y%m%d-%H:%M:%S', time.localtime(t)), host, rng.randrange(20),
+                        relpath, ' '.join(rng.choice(ARGS) for i in range(rng.randrange(5)))))
+                data = ''.join(lines)
+                with open(path, 'w') as f:
+                    f.write(data)
+                os.utime(path, (t, t))
+                n_bytes += len(data)
+    return n_bytes
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark merging many collated files, as consolidate does.
+
+    $ python -m benchmarks.merge --inputs 1000 --lines 100
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from snoopy_log_collator.KeyedReader import KeyedReader
+from snoopy_log_collator.KeyedReaderHeap import KeyedReaderHeap
+from snoopy_log_collator.KeyedReaderTree import KeyedReaderTree
+from snoopy_log_collator.PostProcessor import PostProcessor
+from snoopy_log_collator.util import timestamp_from_str
+
+def pendulum_timestamp(line):
+    """The key function used with KeyedReaderTree before KeyedReaderHeap."""
+    return timestamp_from_str(line.split(maxsplit=1)[0])
+
+def write_inputs(dirpath, n_inputs, n_lines, rng):
+    paths = []
+    for i in range(n_inputs):
+        path = os.path.join(dirpath, 'host%04d' % i)
+        t = 1520000000 + rng.randrange(86400)
+        with open(path, 'w') as f:
+            for j in range(n_lines):
+                t += rng.randrange(120)
+                f.write('%s host%04d user%d /usr/bin/gunzip -c /usr/share/man/man1/x%d.1.gz\n' % (time.strftime('%Y%m%d-%H:%M:%S', time.localtime(t)), i, rng.randrange(50), j))
+        paths.append(path)
+    return paths
+
+def merge(merger, paths, keyfn):
+    start = time.perf_counter()
+    for path in paths:
+        merger.insert(KeyedReader(path, keyfn))
+    n = 0
+    for line in merger.lines():
+        n += 1
+    # as consolidate does, parse only the last key
+    lastkey = merger.lastkey if not isinstance(merger.lastkey, str) else timestamp_from_str(merger.lastkey)
+    return n, lastkey, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark merging collated files')
+    parser.add_argument('--inputs', type=int, default=1000, help='number of files to merge')
+    parser.add_argument('--lines', type=int, default=100, help='lines per file')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    dirpath = tempfile.mkdtemp(prefix='snoopy-merge-bench-')
+    try:
+        paths = write_inputs(dirpath, args.inputs, args.lines, random.Random(args.seed))
+        results = [
+            ('tree, pendulum keys', merge(KeyedReaderTree(), paths, pendulum_timestamp)),
+            ('tree, string keys', merge(KeyedReaderTree(), paths, PostProcessor.timestamp)),
+            ('heap, string keys', merge(KeyedReaderHeap(), paths, PostProcessor.timestamp)),
+        ]
+    finally:
+        shutil.rmtree(dirpath)
+    lastkeys = set(result[1] for name, result in results)
+    if len(lastkeys) != 1:
+        sys.stderr.write('error: merges disagree on last key %s\n' % lastkeys)
+        sys.exit(1)
+    for name, (n, lastkey, elapsed) in results:
+        sys.stdout.write('%-20s %8d lines %8.3fs %10.0f lines/s\n' % (name, n, elapsed, n / elapsed))
+
+if __name__ == '__main__':
+    main()
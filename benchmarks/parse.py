@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark parsing snoopy log lines, as collate does.
+
+    $ python -m benchmarks.parse --lines 100000
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+
+from snoopy_log_collator.LineParser import DEFAULT_MESSAGE_FORMAT, FIELD_RE, LineParser
+
+from .generate import ARGS, MONTHS
+
+# the message_format of more recent versions of snoopy
+OTHER_MESSAGE_FORMAT = '[login:%{login} ssh:(%{env:SSH_CONNECTION}) sid:%{sid} tty:%{tty} (%{tty_uid}/%{tty_username}) uid:%{username}(%{uid})/%{eusername}(%{euid}) cwd:%{cwd} filename:%{filename}]: %{cmdline}'
+
+def get_tagged_fields(s):
+    """Extract tagged snoopy fields as a dict, as Reader did before LineParser."""
+    cunningRE = re.compile(r"""(\s+[a-z]+:)""")
+    cunningSplit = re.split(cunningRE, s)
+    toks = cunningSplit[0].split(':', 1) + cunningSplit[1:]
+    fields = {}
+    for i in range(len(toks) // 2):
+        tag = toks[2 * i].lstrip().rstrip(':')
+        value = toks[2 * i + 1]
+        fields[tag] = value
+    return fields
+
+loglineRE = re.compile(r"""^(\S+\s+\d+\s+\d+:\d+:\d+)\s+(\S+)\s+\S+\[(\d+)\]:\s+\[([^\]]*)\]:\s+(.*)$""")
+
+def tagged_parse(line):
+    """Parse a line as Reader did before LineParser, returning what LineParser.parse does."""
+    logline = line.decode('utf-8')
+    m = loglineRE.match(logline)
+    if m is None:
+        return None
+    return m.group(1), get_tagged_fields(m.group(4)), m.group(5).rstrip()
+
+def make_lines(message_format, n_lines, rng):
+    """Return n_lines snoopy log lines as bytes, with message_format."""
+    lines = []
+    for i in range(n_lines):
+        uid = rng.randrange(1000, 1020)
+        pid = rng.randrange(1000, 32768)
+        values = {
+            'uid': str(uid),
+            'euid': str(uid),
+            'username': 'user%d' % uid,
+            'eusername': 'user%d' % uid,
+            'login': 'user%d' % uid,
+            'sid': str(pid - 7),
+            'tty': '/dev/pts/%d' % (pid % 10),
+            'cwd': '/home/user %d' % uid,
+            'filename': '/usr/bin/prog%03d' % rng.randrange(100),
+        }
+        values['cmdline'] = ('%s %s' % (values['filename'], ' '.join(rng.choice(ARGS) for i in range(rng.randrange(5))))).rstrip()
+        message = FIELD_RE.sub(lambda m: values.get(m.group(1), '-'), message_format)
+        lines.append(('%s %2d %02d:%02d:%02d benchhost snoopy[%d]: %s\n' % (
+            MONTHS[i % 12], i % 28 + 1, i % 24, i % 60, i % 60, pid, message)).encode('utf-8'))
+    return lines
+
+def parse(parsefn, lines, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        results = [parsefn(line) for line in lines]
+    return results, (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark parsing snoopy log lines')
+    parser.add_argument('--lines', type=int, default=100000, help='number of lines to parse')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times to parse them')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    lines = make_lines(DEFAULT_MESSAGE_FORMAT, args.lines, random.Random(args.seed))
+    other_lines = make_lines(OTHER_MESSAGE_FORMAT, args.lines, random.Random(args.seed))
+    results = [
+        ('regex, tagged fields', parse(tagged_parse, lines, args.repeat)),
+        ('LineParser', parse(LineParser().parse, lines, args.repeat)),
+        ('LineParser, other format', parse(LineParser(OTHER_MESSAGE_FORMAT).parse, other_lines, args.repeat)),
+    ]
+    needed = ['uid', 'cwd', 'filename']
+    parsed = set()
+    for name, (lines_parsed, elapsed) in results:
+        parsed.add(tuple((timestamp, tuple(fields[field] for field in needed), command) for timestamp, fields, command in lines_parsed))
+    if len(parsed) != 1:
+        sys.stderr.write('error: parsers disagree\n')
+        sys.exit(1)
+    for name, (lines_parsed, elapsed) in results:
+        sys.stdout.write('%-26s %8d lines %8.3fs %10.0f lines/s\n' % (name, len(lines_parsed), elapsed, len(lines_parsed) / elapsed))
+
+if __name__ == '__main__':
+    main()
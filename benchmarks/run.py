@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark collate and consolidate on synthetic data, with stub rpm and yum.
+
+    $ python -m benchmarks.run collate --days 4 --lines-per-day 20000
+    $ python -m benchmarks.run consolidate --hosts 10 --files 200
+    $ python -m benchmarks.run export --hosts 10 --files 200
+    $ python -m benchmarks.run startup --repeat 10
+"""
+
+import argparse
+import datetime
+import os
+import os.path
+import pendulum
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from snoopy_log_collator.__main__ import make_parser
+from snoopy_log_collator.ColumnarExport import read_export
+from snoopy_log_collator.Compression import read_consolidated
+from snoopy_log_collator.Decompression import open_logfile, read_lines
+from snoopy_log_collator.PostProcessor import PostProcessor
+from snoopy_log_collator.Reader import Reader
+from snoopy_log_collator.Scanner import Scanner
+from snoopy_log_collator.Stats import stats
+
+from .generate import generate_collation_tree, generate_logs, make_binaries
+
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+CONFIG = """log-dir = "{root}/log"
+collation-dir = "{root}/collated"
+consolidation-dir = "{root}/consolidated"
+consolidation-compression = "{compression}"
+
+[class.bifo.exclude]
+yum-repo = ["epel"]
+file = ["/tool 0.*"]
+
+[class.other.include]
+rpm = ["pkg-prog00.*"]
+
+[class.other.exclude]
+rpm = [".*"]
+"""
+
+CLASSES = ['bifo', 'other']
+
+# the commands run by the startup benchmark, with the most seconds each may take,
+# as these are run from monitoring checks, so should start quickly
+STARTUP_BUDGETS = [
+    ('version', [], 0.15),
+    ('list-files', [CLASSES[0]], 0.25),
+    ('query', ['--since', '20180101', '/usr/bin/prog0000'], 0.25),
+]
+
+class NullCollator(object):
+    """Counts commands rather than collating them."""
+
+    full = False
+
+    def __init__(self):
+        self.n = 0
+
+    def command(self, timestamp, fields, command, timestamp_s=None):
+        self.n += 1
+
+class Timer(object):
+
+    def __init__(self):
+        self.stages = []
+
+    def time(self, stage, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        self.stages.append((stage, time.perf_counter() - start))
+        return result
+
+    def write(self, f, amount, unit):
+        for stage, elapsed in self.stages:
+            f.write('%-28s %8.3fs %12.1f %s/s\n' % (stage, elapsed, amount / elapsed, unit))
+
+class MethodTimer(object):
+    """Accumulates the time spent in a method of a class, while installed."""
+
+    def __init__(self, cls, name):
+        self.elapsed = 0.0
+        self._cls = cls
+        self._name = name
+        self._method = getattr(cls, name)
+
+    def __enter__(self):
+        method = self._method
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.elapsed += time.perf_counter() - start
+        setattr(self._cls, self._name, timed)
+        return self
+
+    def __exit__(self, *exc):
+        setattr(self._cls, self._name, self._method)
+
+def setup(root, extra_args, compression='none'):
+    with open(os.path.join(root, 'config.toml'), 'w') as f:
+        f.write(CONFIG.format(root=root, compression=compression))
+    os.environ['PATH'] = '%s:%s' % (STUBS_DIR, os.environ['PATH'])
+    os.environ['SNOOPY_BENCH_ROOT'] = os.path.join(root, 'bin')
+    args = make_parser().parse_args(['-c', os.path.join(root, 'config.toml')] + extra_args)
+    stats.enabled = args.stats is not None
+    return args
+
+def logfiles(logdir):
+    tz = pendulum.now().timezone
+    for entry in sorted(os.listdir(logdir)):
+        dt = datetime.datetime.strptime(entry, 'snoopy-%Y%m%d.gz')
+        yield entry, pendulum.DateTime(dt.year, dt.month, dt.day, tzinfo=tz)
+
+def decompress_all(args, logdir):
+    n = 0
+    for entry in os.listdir(logdir):
+        f = open_logfile(os.path.join(logdir, entry), external=args.external_decompression)
+        try:
+            for line in read_lines(f):
+                n += 1
+        finally:
+            f.close()
+    return n
+
+def parse_all(args, logdir):
+    collator = NullCollator()
+    config = Scanner(args)._config
+    for entry, logfile_dt in logfiles(logdir):
+        Reader(entry, logfile_dt, config, args.external_decompression).collate_to(collator)
+    return collator.n
+
+def collate(args):
+    Scanner(args).scan()
+
+def bench_collate(root, opts, extra_args):
+    rng = random.Random(opts.seed)
+    binaries = make_binaries(os.path.join(root, 'bin'), opts.binaries)
+    n = generate_logs(os.path.join(root, 'log'), binaries, rng, days=opts.days, lines_per_day=opts.lines_per_day, n_users=opts.users)
+    args = setup(root, extra_args + ['collate'])
+    timer = Timer()
+    timer.time('decompress', decompress_all, args, os.path.join(root, 'log'))
+    timer.time('decompress+parse', parse_all, args, os.path.join(root, 'log'))
+    timer.time('collate, cold mapper cache', collate, args)
+    # again, with the mapper cache as left by the first run
+    collated = os.path.join(root, 'collated')
+    for entry in os.listdir(collated):
+        if not entry.endswith('.mapper.sqlite'):
+            path = os.path.join(collated, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    timer.time('collate, warm mapper cache', collate, args)
+    sys.stdout.write('collate: %d lines in %d logfiles\n' % (n, opts.days))
+    timer.write(sys.stdout, n, 'lines')
+    if args.stats is not None:
+        stats.write(sys.stdout, args.stats)
+
+def bench_consolidate(root, opts, extra_args):
+    rng = random.Random(opts.seed)
+    hosts = ['host%03d' % i for i in range(opts.hosts)]
+    relpaths = ['usr/bin/prog%04d' % i for i in range(opts.files)]
+    n_bytes = generate_collation_tree(os.path.join(root, 'collated'), CLASSES, hosts, relpaths, rng, lines_per_file=opts.lines_per_file)
+    args = setup(root, extra_args + ['consolidate'], opts.compression)
+    timer = Timer()
+    with MethodTimer(PostProcessor, '_consolidate_relpath') as merge, MethodTimer(PostProcessor, '_finalize_consolidated') as finalize:
+        timer.time('consolidate', PostProcessor(args).consolidate)
+    timer.stages.append(('  merge', merge.elapsed))
+    timer.stages.append(('  finalize', finalize.elapsed))
+    sys.stdout.write('consolidate: %.1f MB in %d files from %d hosts, %.1f MB consolidated\n' % (
+        n_bytes / 1e6, len(CLASSES) * opts.files * opts.hosts, opts.hosts, tree_size(os.path.join(root, 'consolidated')) / 1e6))
+    timer.write(sys.stdout, n_bytes / 1e6, 'MB')
+    if args.stats is not None:
+        stats.write(sys.stdout, args.stats)
+
+def tree_size(top):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, ds, fs in os.walk(top) for f in fs)
+
+def read_text(root, cls):
+    """Read the consolidated text files for cls, as analysts did before export."""
+    n = 0
+    for dirpath, dirs, files in os.walk(os.path.join(root, 'consolidated', cls, 'ALL')):
+        for filename in files:
+            for line in read_consolidated(os.path.join(dirpath, filename)):
+                timestamp, host, user, args = line.decode('utf-8').split(' ', 3)
+                n += 1
+    return n
+
+def bench_export(root, opts, extra_args):
+    rng = random.Random(opts.seed)
+    hosts = ['host%03d' % i for i in range(opts.hosts)]
+    relpaths = ['usr/bin/prog%04d' % i for i in range(opts.files)]
+    generate_collation_tree(os.path.join(root, 'collated'), CLASSES, hosts, relpaths, rng, lines_per_file=opts.lines_per_file)
+    PostProcessor(setup(root, extra_args + ['consolidate'], opts.compression)).consolidate()
+    args = setup(root, extra_args + ['export'], opts.compression)
+    path = os.path.join(root, 'consolidated', CLASSES[0], 'ALL.export')
+    timer = Timer()
+    timer.time('export', PostProcessor(args).export, [CLASSES[0]])
+    timer.time('read text', read_text, root, CLASSES[0])
+    timer.time('read export', read_export, path)
+    timer.time('read export time,user', read_export, path, ['time', 'user'])
+    n = opts.hosts * opts.files * opts.lines_per_file
+    sys.stdout.write('export: %d rows, %.1f MB exported from %.1f MB\n' % (
+        n, os.path.getsize(path) / 1e6, tree_size(os.path.join(root, 'consolidated', CLASSES[0], 'ALL')) / 1e6))
+    timer.write(sys.stdout, n, 'rows')
+    if args.stats is not None:
+        stats.write(sys.stdout, args.stats)
+
+def bench_startup(root, opts, extra_args):
+    """Time each quick command in a fresh interpreter, as run from monitoring checks."""
+    rng = random.Random(opts.seed)
+    relpaths = ['usr/bin/prog%04d' % i for i in range(10)]
+    # some consolidated files to query, and some collated files to list
+    generate_collation_tree(os.path.join(root, 'collated'), CLASSES, ['host000', 'host001'], relpaths, rng, lines_per_file=10)
+    PostProcessor(setup(root, extra_args + ['consolidate'])).consolidate()
+    generate_collation_tree(os.path.join(root, 'collated'), CLASSES, ['host000', 'host001'], relpaths, rng, lines_per_file=10)
+    over = False
+    for command, command_args, budget in STARTUP_BUDGETS:
+        argv = [sys.executable, '-m', 'snoopy_log_collator', '-c', os.path.join(root, 'config.toml')] + extra_args + [command] + command_args
+        times = []
+        # the first run is not counted, as that builds the manifests
+        for i in range(opts.repeat + 1):
+            start = time.perf_counter()
+            subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        elapsed = statistics.median(times[1:])
+        over = over or elapsed > budget
+        sys.stdout.write('%-28s %8.3fs   budget %.3fs %s\n' % (command, elapsed, budget, 'ok' if elapsed <= budget else 'OVER BUDGET'))
+    if over:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark snoopy-log-collator')
+    parser.add_argument('benchmark', choices=['collate', 'consolidate', 'export', 'startup'], help='benchmark to run')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--days', type=int, default=4, help='collate: number of daily logfiles, starting on Dec 30')
+    parser.add_argument('--lines-per-day', type=int, default=20000, help='collate: lines in each logfile')
+    parser.add_argument('--binaries', type=int, default=200, help='collate: number of distinct programs')
+    parser.add_argument('--users', type=int, default=20, help='collate: number of distinct users')
+    parser.add_argument('--hosts', type=int, default=10, help='consolidate, export: number of hosts')
+    parser.add_argument('--files', type=int, default=200, help='consolidate, export: collated files per host')
+    parser.add_argument('--lines-per-file', type=int, default=1000, help='consolidate, export: lines per collated file')
+    parser.add_argument('--compression', choices=['none', 'gzip', 'zstd'], default='none', help='consolidate, export: consolidation-compression')
+    parser.add_argument('--repeat', type=int, default=10, help='startup: number of times to run each command')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark directory')
+    parser.epilog = 'Any arguments after -- are passed as options to snoopy-log-collator.'
+    argv = sys.argv[1:]
+    extra_args = []
+    if '--' in argv:
+        i = argv.index('--')
+        argv, extra_args = argv[:i], argv[i + 1:]
+    opts = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='snoopy-bench-')
+    try:
+        if opts.benchmark == 'collate':
+            bench_collate(root, opts, extra_args)
+        elif opts.benchmark == 'consolidate':
+            bench_consolidate(root, opts, extra_args)
+        elif opts.benchmark == 'export':
+            bench_export(root, opts, extra_args)
+        else:
+            bench_startup(root, opts, extra_args)
+    finally:
+        if opts.keep:
+            sys.stdout.write('benchmark directory %s\n' % root)
+        else:
+            shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
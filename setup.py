@@ -28,7 +28,7 @@ setup(name='snoopy-log-collator',
           'Topic :: System :: Systems Administration',
           'Topic :: Utilities',
       ],
-      packages=find_packages(),
+      packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
       entry_points={
         'console_scripts': [
             'snoopy-log-collator = snoopy_log_collator.__main__:main',
@@ -41,7 +41,6 @@ setup(name='snoopy-log-collator',
       install_requires=[
           'pendulum>=2',
           'pytoml',
-          'setuptools',
       ],
-      python_requires='>=3',
+      python_requires='>=3.8',
      )
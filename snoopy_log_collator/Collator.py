@@ -14,38 +14,104 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os.path
-import pendulum
-import re
+import time
 
+from .Stats import stats
 from .util import bare_hostname, timestamp_str
+from .WriterPool import WriterPool
 
 class Collator(object):
-    def __init__(self, config, mapper):
+    def __init__(self, config, mapper, spooldir=None, journal=None, manifest=None, compact=False):
+        """If spooldir is given, collate into that instead of the collation-dir.
+        If journal is given, record appends there before each flush.
+        If manifest is given, record the appends there after each flush,
+        otherwise keep them for take_appended.
+        If compact, write runs of identical lines as single lines with a repeat count."""
         self._config = config
         self._mapper = mapper
+        self._spooldir = spooldir
+        self._manifest = manifest
         self._hostname = bare_hostname()
+        self._writers = WriterPool(journal=journal, compact=compact)
+        # the class and relpath of each output file
+        self._relpaths = {}
+        self._appended = {}
+
+    def _outdir(self, cls):
+        if self._spooldir is None:
+            return self._config.localhost_collation_dir(cls)
+        else:
+            return os.path.join(self._spooldir, cls)
 
     def _outpath(self, cls, filename):
         if os.path.isabs(filename):
-            path = os.path.join(self._config.localhost_collation_dir(cls), filename[1:])
+            path = os.path.join(self._outdir(cls), filename[1:])
         else:
-            path = os.path.join(self._config.localhost_collation_dir(cls), filename)
+            path = os.path.join(self._outdir(cls), filename)
         return os.path.normpath(path)
 
-    def command(self, timestamp, fields, command):
+    @staticmethod
+    def _filepath(fields):
         filename = fields['filename']
         if os.path.isabs(filename):
-            filepath = filename
+            return filename
         else:
-            filepath = os.path.normpath(os.path.join(fields['cwd'], filename))
+            return os.path.normpath(os.path.join(fields['cwd'], filename))
+
+    def prefetch(self, fields, executor):
+        """Start on executor any lookups which command will need for fields, so
+        they run while earlier commands are collated."""
+        self._mapper.prefetch(self._filepath(fields), self._config, executor)
+
+    def end_prefetch(self):
+        """Forget any lookups started by prefetch but not needed."""
+        self._mapper.end_prefetch()
+
+    def command(self, timestamp, fields, command, timestamp_s=None):
+        if timestamp_s is None:
+            timestamp_s = timestamp_str(timestamp)
+        filepath = self._filepath(fields)
+        if stats.enabled:
+            start = time.perf_counter()
         user = self._mapper.username(int(fields['uid']))
         if self._mapper.isfile(filepath):
-            for cls in self._config.classes_with_all:
-                if not self._mapper.excluded(filepath, cls, self._config):
-                    outpath = self._outpath(cls, filepath)
-                    if not os.path.exists(outpath):
-                        os.makedirs(os.path.dirname(outpath), exist_ok=True)
-                    with open(outpath, 'a') as outf:
-                        outf.write('%s %s %s %s\n' % (timestamp_str(timestamp), self._hostname, user, command))
-                    t = timestamp.int_timestamp
-                    os.utime(outpath, (t, t))
+            outpaths = [(cls, self._outpath(cls, filepath)) for cls in self._config.classes_with_all if not self._mapper.excluded(filepath, cls, self._config)]
+        else:
+            outpaths = []
+        if stats.enabled:
+            stats.add_time('collate: classify', time.perf_counter() - start)
+        if len(outpaths) > 0:
+            line = '%s %s %s %s\n' % (timestamp_s, self._hostname, user, command)
+            t = timestamp.int_timestamp
+            for cls, outpath in outpaths:
+                self._writers.write(outpath, line, t)
+                if outpath not in self._relpaths:
+                    self._relpaths[outpath] = (cls, os.path.relpath(outpath, self._outdir(cls)))
+
+    @property
+    def full(self):
+        """Whether enough has been collated that it is time to flush."""
+        return self._writers.full
+
+    def flush(self):
+        """Write out everything collated so far."""
+        written = self._writers.flush()
+        for outpath, (n_bytes, n_lines, last) in written.items():
+            key = self._relpaths[outpath]
+            if key in self._appended:
+                appended = self._appended[key]
+                self._appended[key] = (appended[0] + n_bytes, appended[1] + n_lines, last)
+            else:
+                self._appended[key] = (n_bytes, n_lines, last)
+        if self._manifest is not None:
+            for (cls, relpath), (n_bytes, n_lines, last) in self._appended.items():
+                self._manifest.append(cls, self._hostname, relpath, n_bytes, n_lines, last)
+            self._manifest.commit()
+            self._appended = {}
+
+    def take_appended(self):
+        """Remove and return what has been flushed since last time, as a list of
+        (cls, relpath, n_bytes, n_lines, last), e.g. for another process to record in a Manifest."""
+        appended = [key + value for key, value in self._appended.items()]
+        self._appended = {}
+        return appended
@@ -0,0 +1,352 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A compact columnar format for consolidated invocations.
+
+An export file is a header followed by segments, each appended by a
+single export run, so that exports are incremental.  Each segment has the
+following sections, each preceded by its length as a little-endian uint64:
+
+    new hosts, users and paths, NUL-separated, extending the dictionaries
+    time: int64 seconds since the epoch, one per row
+    host, user, path: uint32 indices into the dictionaries, one per row
+    args end: uint64 offset of the end of each row's arguments in args
+    args: the UTF-8 argument strings, concatenated
+    progress: JSON, how far each consolidated file has been exported, and
+        which paths were exported afresh, superseding their earlier rows
+
+and a trailer comprising the segment length and SEGMENT_END, so that an
+incomplete segment left by an interrupted export can be detected and
+discarded."""
+
+import array
+import json
+import os
+import struct
+import sys
+
+from .UserError import UserError
+
+MAGIC = b'SLCXPORT'
+VERSION = 1
+SEGMENT_START = b'SLCXSEG1'
+SEGMENT_END = b'SLCXEND1'
+
+HEADER = struct.Struct('<8sI')
+SECTION = struct.Struct('<Q')
+TRAILER = struct.Struct('<Q8s')
+
+SECTIONS = ['hosts', 'users', 'paths', 'time', 'host', 'user', 'path', 'args end', 'args', 'progress']
+TYPECODES = {'time': 'q', 'host': 'I', 'user': 'I', 'path': 'I', 'args end': 'Q'}
+
+# the columns which may be loaded
+COLUMNS = ['time', 'host', 'user', 'path', 'args']
+
+class ExportError(UserError):
+
+    def __init__(self, path, msg):
+        self.path = path
+        self.msg = msg
+
+    def __str__(self):
+        return('Export error %s: %s' % (self.path, self.msg))
+
+def _to_bytes(a):
+    if sys.byteorder != 'little':
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+def _extend_from_bytes(a, data):
+    if sys.byteorder != 'little':
+        b = array.array(a.typecode)
+        b.frombytes(data)
+        b.byteswap()
+        a.extend(b)
+    else:
+        a.frombytes(data)
+
+def _split_names(data):
+    return data.decode('utf-8').split('\0') if len(data) > 0 else []
+
+def _segments(f, path):
+    """Yield the offset of each complete segment in f, with a dict of the
+    offset and length of each of its sections."""
+    f.seek(0)
+    header = f.read(HEADER.size)
+    if len(header) == 0:
+        return
+    if len(header) < HEADER.size or header[:8] != MAGIC:
+        raise ExportError(path, 'not an export file')
+    if HEADER.unpack(header)[1] != VERSION:
+        raise ExportError(path, 'unsupported version %d' % HEADER.unpack(header)[1])
+    end = f.seek(0, os.SEEK_END)
+    start = HEADER.size
+    while start < end:
+        f.seek(start)
+        if f.read(len(SEGMENT_START)) != SEGMENT_START:
+            break
+        sections = {}
+        offset = start + len(SEGMENT_START)
+        complete = True
+        for name in SECTIONS:
+            f.seek(offset)
+            length_s = f.read(SECTION.size)
+            if len(length_s) < SECTION.size:
+                complete = False
+                break
+            length = SECTION.unpack(length_s)[0]
+            sections[name] = (offset + SECTION.size, length)
+            offset += SECTION.size + length
+        if not complete or offset + TRAILER.size > end:
+            break
+        f.seek(offset)
+        length, marker = TRAILER.unpack(f.read(TRAILER.size))
+        if marker != SEGMENT_END or length != offset - start:
+            break
+        yield start, sections
+        start = offset + TRAILER.size
+
+def _read_section(f, sections, name):
+    offset, length = sections[name]
+    f.seek(offset)
+    return f.read(length)
+
+class ExportWriter(object):
+    """An ExportWriter appends segments of rows to an export file, creating
+    it if necessary.  The rows are buffered until flushed as a segment."""
+
+    def __init__(self, path):
+        self._path = path
+        self.hosts = []
+        self.users = []
+        self.paths = []
+        # how far each consolidated file has been exported, as (inode, offset)
+        self.progress = {}
+        end = HEADER.size
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for start, sections in _segments(f, path):
+                    self.hosts.extend(_split_names(_read_section(f, sections, 'hosts')))
+                    self.users.extend(_split_names(_read_section(f, sections, 'users')))
+                    self.paths.extend(_split_names(_read_section(f, sections, 'paths')))
+                    progress = json.loads(_read_section(f, sections, 'progress').decode('utf-8'))
+                    for relpath, inode_offset in progress['files'].items():
+                        self.progress[relpath] = tuple(inode_offset)
+                    offset, length = sections['progress']
+                    end = offset + length + TRAILER.size
+        self._end = end
+        self._ids = {name: {s: i for i, s in enumerate(getattr(self, name))} for name in ['hosts', 'users', 'paths']}
+        self._start_segment()
+
+    def _start_segment(self):
+        self._n_names = {name: len(getattr(self, name)) for name in ['hosts', 'users', 'paths']}
+        self._time = array.array(TYPECODES['time'])
+        self._host = array.array(TYPECODES['host'])
+        self._user = array.array(TYPECODES['user'])
+        self._pathcol = array.array(TYPECODES['path'])
+        self._args_end = array.array(TYPECODES['args end'])
+        self._args = []
+        self._args_size = 0
+        self._files = {}
+        self._reset = []
+
+    def __len__(self):
+        return len(self._time)
+
+    def _id(self, name, s):
+        ids = self._ids[name]
+        try:
+            return ids[s]
+        except KeyError:
+            i = len(ids)
+            ids[s] = i
+            getattr(self, name).append(s)
+            return i
+
+    def reset(self, relpath):
+        """Supersede all rows previously exported for relpath, which is being exported afresh."""
+        self._reset.append(self._id('paths', relpath))
+
+    def add(self, t, host, user, relpath, args):
+        self._time.append(t)
+        self._host.append(self._id('hosts', host))
+        self._user.append(self._id('users', user))
+        self._pathcol.append(self._id('paths', relpath))
+        args_bytes = args.encode('utf-8')
+        self._args.append(args_bytes)
+        self._args_size += len(args_bytes)
+        self._args_end.append(self._args_size)
+
+    def set_progress(self, relpath, inode, offset):
+        self.progress[relpath] = (inode, offset)
+        self._files[relpath] = (inode, offset)
+
+    def flush(self):
+        """Append a segment, if there is anything new, discarding any incomplete segment left before."""
+        if len(self._files) == 0:
+            return
+        sections = {}
+        for name in ['hosts', 'users', 'paths']:
+            sections[name] = '\0'.join(getattr(self, name)[self._n_names[name]:]).encode('utf-8')
+        sections['time'] = _to_bytes(self._time)
+        sections['host'] = _to_bytes(self._host)
+        sections['user'] = _to_bytes(self._user)
+        sections['path'] = _to_bytes(self._pathcol)
+        sections['args end'] = _to_bytes(self._args_end)
+        sections['args'] = b''.join(self._args)
+        sections['progress'] = json.dumps({'files': self._files, 'reset': self._reset}, sort_keys=True).encode('utf-8')
+        with open(self._path, 'r+b' if os.path.exists(self._path) else 'w+b') as f:
+            if self._end == HEADER.size:
+                f.write(HEADER.pack(MAGIC, VERSION))
+            f.seek(self._end)
+            f.truncate()
+            length = len(SEGMENT_START)
+            f.write(SEGMENT_START)
+            for name in SECTIONS:
+                f.write(SECTION.pack(len(sections[name])))
+                f.write(sections[name])
+                length += SECTION.size + len(sections[name])
+            f.write(TRAILER.pack(length, SEGMENT_END))
+            f.flush()
+            os.fsync(f.fileno())
+            self._end = f.tell()
+        self._start_segment()
+
+    def close(self):
+        self.flush()
+
+class ExportTable(object):
+    """The rows of an export file, as columns.
+
+    time is an array of seconds since the epoch, and host, user and path are
+    arrays of indices into the lists hosts, users and paths.  Only the columns
+    loaded are present, the others being None."""
+
+    def __init__(self):
+        self.hosts = []
+        self.users = []
+        self.paths = []
+        self.time = None
+        self.host = None
+        self.user = None
+        self.path = None
+        self._args_end = None
+        self._args = None
+
+    def __len__(self):
+        for column in [self.time, self.host, self.user, self.path, self._args_end]:
+            if column is not None:
+                return len(column)
+        return 0
+
+    def args(self, i):
+        """Return the argument string of row i."""
+        start = self._args_end[i - 1] if i > 0 else 0
+        return self._args[start:self._args_end[i]].decode('utf-8')
+
+    def rows(self, indices=None):
+        """Yield each row, or those in indices, as a tuple of time, host, user, path and args,
+        with None for those columns not loaded."""
+        if indices is None:
+            indices = range(len(self))
+        for i in indices:
+            yield (self.time[i] if self.time is not None else None,
+                   self.hosts[self.host[i]] if self.host is not None else None,
+                   self.users[self.user[i]] if self.user is not None else None,
+                   self.paths[self.path[i]] if self.path is not None else None,
+                   self.args(i) if self._args is not None else None)
+
+    def select(self, host=None, user=None, path=None, start=None, end=None):
+        """Return the indices of the rows matching all of the criteria given,
+        with times in [start, end), which requires the relevant columns to be loaded."""
+        tests = []
+        for value, names, column in [(host, self.hosts, self.host), (user, self.users, self.user), (path, self.paths, self.path)]:
+            if value is not None:
+                try:
+                    tests.append((column, names.index(value)))
+                except ValueError:
+                    return []
+        indices = range(len(self))
+        for column, i in tests:
+            indices = [j for j in indices if column[j] == i]
+        if start is not None:
+            indices = [j for j in indices if self.time[j] >= start]
+        if end is not None:
+            indices = [j for j in indices if self.time[j] < end]
+        return list(indices)
+
+def read_export(path, columns=COLUMNS):
+    """Read an export file, loading only the columns given, into an ExportTable."""
+    table = ExportTable()
+    # the path column is also needed to drop superseded rows
+    for name in ['time', 'host', 'user', 'path']:
+        if name in columns or name == 'path':
+            setattr(table, name, array.array(TYPECODES[name]))
+    if 'args' in columns:
+        table._args_end = array.array(TYPECODES['args end'])
+        args = []
+        args_size = 0
+    segments = []
+    with open(path, 'rb') as f:
+        for start, sections in _segments(f, path):
+            for name in ['hosts', 'users', 'paths']:
+                getattr(table, name).extend(_split_names(_read_section(f, sections, name)))
+            progress = json.loads(_read_section(f, sections, 'progress').decode('utf-8'))
+            segments.append((sections['path'][1] // 4, progress['reset']))
+            for name in ['time', 'host', 'user', 'path']:
+                if getattr(table, name) is not None:
+                    _extend_from_bytes(getattr(table, name), _read_section(f, sections, name))
+            if 'args' in columns:
+                segment_args_end = array.array(TYPECODES['args end'])
+                _extend_from_bytes(segment_args_end, _read_section(f, sections, 'args end'))
+                table._args_end.extend(end + args_size for end in segment_args_end)
+                args.append(_read_section(f, sections, 'args'))
+                args_size += sections['args'][1]
+    if 'args' in columns:
+        table._args = b''.join(args)
+    _drop_superseded(table, segments)
+    if 'path' not in columns:
+        table.path = None
+    return table
+
+def _drop_superseded(table, segments):
+    """Drop the rows for paths which were exported afresh in a later segment."""
+    reset_at = {}
+    for i, (n_rows, reset) in enumerate(segments):
+        for path_id in reset:
+            reset_at[path_id] = i
+    if len(reset_at) == 0:
+        return
+    keep = []
+    start = 0
+    for i, (n_rows, reset) in enumerate(segments):
+        keep.extend(j for j in range(start, start + n_rows) if reset_at.get(table.path[j], -1) <= i)
+        start += n_rows
+    for name in ['time', 'host', 'user', 'path']:
+        column = getattr(table, name)
+        if column is not None:
+            setattr(table, name, array.array(column.typecode, (column[j] for j in keep)))
+    if table._args is not None:
+        args = []
+        args_end = array.array(TYPECODES['args end'])
+        size = 0
+        for j in keep:
+            arg = table._args[table._args_end[j - 1] if j > 0 else 0:table._args_end[j]]
+            args.append(arg)
+            size += len(arg)
+            args_end.append(size)
+        table._args = b''.join(args)
+        table._args_end = args_end
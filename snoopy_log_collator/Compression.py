@@ -0,0 +1,243 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Consolidated files may be stored compressed, as a sequence of independently
+# compressed members, which is what both gzip and zstd produce when
+# compressed files are concatenated.  Members always start at the start of a
+# line, so reading may start at any member, and appending to a file is simply
+# writing more members at its end.  Compressed files keep the same names as
+# plain ones, and are recognised by their first bytes, so the two may be
+# mixed, though a file is always appended to in its existing compression.
+
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .Decompression import CHUNK_SIZE, DecompressionError, read_lines
+from .UserError import UserError
+
+# how much of a collated file to compress into each member of a consolidated copy of it
+MEMBER_SIZE = 1048576
+
+# how much text a CompressedWriter buffers before compressing it, as compressing line by line is slow
+WRITE_BUFFER_SIZE = 65536
+
+def _gzip_compressor():
+    # wbits 31 is deflate with a gzip header and trailer
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+def _gzip_decompressor():
+    return zlib.decompressobj(31)
+
+def _zstd_compressor():
+    if zstandard is None:
+        return None
+    return zstandard.ZstdCompressor().compressobj()
+
+def _zstd_decompressor():
+    if zstandard is None:
+        return None
+    return zstandard.ZstdDecompressor().decompressobj()
+
+# for each compression of consolidated files, the magic number at the start of
+# each member, and how to start compressing and decompressing a member,
+# returning None if that isn't possible
+COMPRESSIONS = {
+    'gzip': (b'\x1f\x8b', _gzip_compressor, _gzip_decompressor),
+    'zstd': (b'\x28\xb5\x2f\xfd', _zstd_compressor, _zstd_decompressor),
+}
+
+DECOMPRESSION_ERRORS = (zlib.error,) if zstandard is None else (zlib.error, zstandard.ZstdError)
+
+class CompressionError(UserError):
+
+    def __init__(self, path, msg):
+        self.path = path
+        self.msg = msg
+
+    def __str__(self):
+        return('Compression error %s: %s' % (self.path, self.msg))
+
+def file_compression(path):
+    """Return the compression of a consolidated file, judged by its first bytes, or None if it is plain or empty."""
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for compression, (magic, compressor, decompressor) in COMPRESSIONS.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+def read_members(f, path, compression, end=None):
+    """Yield the offset of the start and end of each member of a compressed
+    file, and its uncompressed contents, reading from the current position of
+    f, which must be the start of a member, until end if given.
+
+    A member cut short at the end, e.g. by an append in progress, is ignored."""
+    decompressor = COMPRESSIONS[compression][2]
+    start = f.tell()
+    position = start
+    d = None
+    parts = []
+    while True:
+        chunk = f.read(CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - position))
+        if len(chunk) == 0:
+            break
+        position += len(chunk)
+        while len(chunk) > 0:
+            if d is None:
+                d = decompressor()
+                if d is None:
+                    raise DecompressionError(path, 'no way to decompress %s files found' % compression)
+            try:
+                parts.append(d.decompress(chunk))
+            except DECOMPRESSION_ERRORS as e:
+                raise DecompressionError(path, str(e))
+            if not d.eof:
+                break
+            chunk = d.unused_data
+            member_end = position - len(chunk)
+            yield start, member_end, b''.join(parts)
+            start = member_end
+            d = None
+            parts = []
+
+def read_consolidated(path, offset=0):
+    """Yield the lines of a consolidated file, which may be compressed, as
+    bytes, from offset, which for a compressed file must be the start of a member."""
+    with open(path, 'rb') as f:
+        compression = file_compression(path)
+        f.seek(offset)
+        if compression is None:
+            yield from read_lines(f)
+        else:
+            for start, end, data in read_members(f, path, compression):
+                yield from data.splitlines(keepends=True)
+
+class CompressedWriter(object):
+    """A CompressedWriter writes text to a binary file as compressed members,
+    with the same interface as a text file, for writing consolidated files.
+
+    tell ends the current member, so that reading may start there."""
+
+    def __init__(self, f, compression):
+        self._f = f
+        self._compressor = COMPRESSIONS[compression][1]
+        self._c = None
+        self._buffer = []
+        self._buffered = 0
+        if self._compressor() is None:
+            raise CompressionError(f.name, 'no way to compress %s files found' % compression)
+
+    def write(self, s):
+        self.write_bytes(s.encode('utf-8'))
+
+    def write_bytes(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= WRITE_BUFFER_SIZE:
+            self._compress()
+
+    def _compress(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if len(data) > 0:
+            if self._c is None:
+                self._c = self._compressor()
+            self._f.write(self._c.compress(data))
+
+    def _end_member(self):
+        self._compress()
+        if self._c is not None:
+            self._f.write(self._c.flush())
+            self._c = None
+
+    def tell(self):
+        self._end_member()
+        return self._f.tell()
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def truncate(self, size):
+        self._c = None
+        self._buffer = []
+        self._buffered = 0
+        self._f.truncate(size)
+
+    def close(self):
+        try:
+            self._end_member()
+        finally:
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_consolidated(path, mode, compression=None):
+    """Open a consolidated file for writing text, with mode 'w' or 'a',
+    compressed if compression is given, which must be that of the file if
+    appending to it."""
+    if compression is None:
+        return open(path, mode)
+    f = open(path, mode + 'b')
+    try:
+        return CompressedWriter(f, compression)
+    except:
+        f.close()
+        raise
+
+def compress_file(inpath, outpath, compression, fsync=False, start=0, end=None):
+    """Append the plain file inpath from start, and only up to end if given,
+    compressed to outpath, creating that if necessary, and return the
+    modification time of inpath, for set_timestamps, and the number of bytes
+    written.
+
+    Each member is of about MEMBER_SIZE bytes of whole lines, so that no
+    member is too large to read at once."""
+    with open(inpath, 'rb') as f, open_consolidated(outpath, 'a', compression) as out:
+        f.seek(start)
+        size = out.tell()
+        try:
+            partial = b''
+            remaining = None if end is None else end - start
+            while True:
+                chunk = f.read(MEMBER_SIZE if remaining is None else min(MEMBER_SIZE, remaining))
+                if remaining is not None:
+                    remaining -= len(chunk)
+                if len(chunk) == 0:
+                    break
+                data = partial + chunk
+                i = data.rfind(b'\n') + 1
+                out.write_bytes(data[:i])
+                partial = data[i:]
+                if i > 0:
+                    out.tell()
+            out.write_bytes(partial)
+            n_bytes = out.tell() - size
+            if fsync:
+                os.fsync(out.fileno())
+        except:
+            # don't leave a partial member, which would spoil the rest of the file
+            out.truncate(size)
+            raise
+        return os.fstat(f.fileno()).st_mtime, n_bytes
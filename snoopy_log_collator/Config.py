@@ -13,17 +13,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
 import os.path
 import pytoml as toml
 import re
 import sys
 
+from .LineParser import DEFAULT_MESSAGE_FORMAT, message_format_regex
+from .UserError import UserError
 from .util import bare_hostname
 
 def expand(s):
     return os.path.expanduser(os.path.expandvars(s))
 
-class ConfigError(Exception):
+class ConfigError(UserError):
 
     def __init__(self, filename, msg):
         self.filename = filename
@@ -32,6 +36,48 @@ class ConfigError(Exception):
     def __str__(self):
         return('Configuration error %s: %s' % (self.filename, self.msg))
 
+# inline global flags, which apply to the whole of a pattern wherever they are
+GLOBAL_FLAGS_RE = re.compile(r'\(\?[aiLmsux]+\)')
+
+class Matcher(object):
+    """A Matcher matches a name against any of a list of regexes, fused into a
+    single alternation where possible."""
+
+    def __init__(self, filename, what, patterns):
+        if not isinstance(patterns, list) or not all(isinstance(pattern, str) for pattern in patterns):
+            raise ConfigError(filename, '%s must be a list of strings' % what)
+        regexes = []
+        for pattern in patterns:
+            try:
+                regexes.append(re.compile(pattern))
+            except re.error as e:
+                raise ConfigError(filename, 'invalid regex for %s "%s": %s' % (what, pattern, e))
+        # patterns with groups can't be fused, in case of backreferences, nor
+        # those with global flags, which would apply to the other patterns too
+        fusible = [pattern for pattern, regex in zip(patterns, regexes) if regex.groups == 0 and not GLOBAL_FLAGS_RE.search(pattern)]
+        if len(fusible) > 1:
+            regexes = [regex for pattern, regex in zip(patterns, regexes) if pattern not in fusible]
+            regexes.append(re.compile('|'.join('(?:%s)' % pattern for pattern in fusible)))
+        self._regexes = regexes
+
+    def search(self, name):
+        """Return whether any regex matches anywhere in name."""
+        for regex in self._regexes:
+            if regex.search(name):
+                return True
+        return False
+
+class ClassRules(object):
+    """The include/exclude rules for a class."""
+
+    def __init__(self, filename, cls, config_for_class):
+        include = config_for_class.get('include', {})
+        exclude = config_for_class.get('exclude', {})
+        self.exclude_file = Matcher(filename, 'class.%s.exclude.file' % cls, exclude.get('file', []))
+        self.include_rpm = Matcher(filename, 'class.%s.include.rpm' % cls, include.get('rpm', []))
+        self.exclude_rpm = Matcher(filename, 'class.%s.exclude.rpm' % cls, exclude.get('rpm', []))
+        self.exclude_yum_repo = Matcher(filename, 'class.%s.exclude.yum-repo' % cls, exclude.get('yum-repo', []))
+
 class Config(object):
 
     def __init__(self, args):
@@ -58,10 +104,20 @@ class Config(object):
             except toml.TomlError as e:
                 raise ConfigError(self._filename, 'TOML error at line %d, %s' % (e.line, e.message))
         self._validate()
+        self._rules = {cls: ClassRules(self._filename, cls, config_for_class) for cls, config_for_class in self._config.get('class', {}).items()}
 
     def _validate(self):
         if 'class' in self._config and 'all' in self._config['class']:
             raise ConfigError(self._filename, 'invalid class "all"')
+        if self._config.get('consolidation-compression', 'none') not in ['none', 'gzip', 'zstd']:
+            raise ConfigError(self._filename, 'consolidation-compression must be one of none, gzip or zstd')
+        if 'message-format' in self._config:
+            if not isinstance(self._config['message-format'], str):
+                raise ConfigError(self._filename, 'message-format must be a string')
+            try:
+                message_format_regex(self._config['message-format'])
+            except ValueError as e:
+                raise ConfigError(self._filename, 'invalid message-format: %s' % e)
 
     def localhost_collation_dir(self, cls):
         return os.path.join(expand(self._config['collation-dir']), cls, bare_hostname())
@@ -73,14 +129,62 @@ class Config(object):
         subdir = 'ALL' if host is None else host
         return os.path.join(expand(self._config['consolidation-dir']), cls, subdir)
 
+    def export_file(self, cls):
+        return os.path.join(expand(self._config['consolidation-dir']), cls, 'ALL.export')
+
+    def index_file(self, cls, relpath):
+        """The sidecar TimestampIndex of the file consolidated for relpath."""
+        return os.path.join(expand(self._config['consolidation-dir']), '.index', cls, relpath)
+
     @property
     def last_collation_file(self):
         return os.path.join(expand(self._config['collation-dir']), '.%s.collated' % bare_hostname())
 
+    @property
+    def journal_file(self):
+        return os.path.join(expand(self._config['collation-dir']), '.%s.journal' % bare_hostname())
+
+    @property
+    def follow_checkpoint_file(self):
+        return os.path.join(expand(self._config['collation-dir']), '.%s.following' % bare_hostname())
+
+    @property
+    def mapper_cache_file(self):
+        return os.path.join(expand(self._config['collation-dir']), '.%s.mapper.sqlite' % bare_hostname())
+
+    def collation_manifest_file(self, hostname):
+        return os.path.join(expand(self._config['collation-dir']), '.%s.manifest.sqlite' % hostname)
+
+    @property
+    def consolidation_manifest_file(self):
+        return os.path.join(expand(self._config['consolidation-dir']), '.manifest.sqlite')
+
+    @property
+    def rules_digest(self):
+        """A digest of the include/exclude rules for all classes."""
+        rules = json.dumps(self._config.get('class', {}), sort_keys=True)
+        return hashlib.sha1(rules.encode('utf-8')).hexdigest()
+
+    @property
+    def consolidation_compression(self):
+        """The compression of newly consolidated files, or None if they are plain."""
+        compression = self._config.get('consolidation-compression', 'none')
+        return None if compression == 'none' else compression
+
     @property
     def logdir(self):
         return expand(self._config['log-dir'])
 
+    @property
+    def message_format(self):
+        """The snoopy message_format of the log lines."""
+        return self._config.get('message-format', DEFAULT_MESSAGE_FORMAT)
+
+    @property
+    def active_log(self):
+        """The name of the logfile which snoopy is currently writing, in the log-dir."""
+        return self._config.get('active-log', 'snoopy')
+
     @property
     def classes(self):
         return list(self._config['class'])
@@ -93,66 +197,26 @@ class Config(object):
     def collated_hosts(self, cls):
         return os.listdir(os.path.join(expand(self._config['collation-dir']), cls))
 
-    def _config_for_class(self, cls):
-        if 'class' not in self._config or cls not in self._config['class']:
-            return None
-        else:
-            return self._config['class'][cls]
+    def consolidated_hosts(self, cls):
+        """The hosts whose collated files have been moved into the consolidation-dir for cls."""
+        clsdir = os.path.join(expand(self._config['consolidation-dir']), cls)
+        try:
+            return [e.name for e in os.scandir(clsdir) if e.is_dir() and e.name != 'ALL']
+        except FileNotFoundError:
+            return []
 
     def exclude_file(self, cls, name):
-        config_for_class = self._config_for_class(cls)
-        if config_for_class is not None and 'exclude' in config_for_class:
-            exclude = config_for_class['exclude']
-            if 'file' in exclude:
-                for name_re in exclude['file']:
-                    if re.search(name_re, name):
-                        return True
-                return False
-            else:
-                return False
-        else:
-            return False
+        rules = self._rules.get(cls)
+        return rules is not None and rules.exclude_file.search(name)
 
     def include_rpm(self, cls, name):
-        config_for_class = self._config_for_class(cls)
-        if config_for_class is not None and 'include' in config_for_class:
-            include = config_for_class['include']
-            if 'rpm' in include:
-                for name_re in include['rpm']:
-                    if re.search(name_re, name):
-                        return True
-                return False
-            else:
-                return False
-        else:
-            return False
+        rules = self._rules.get(cls)
+        return rules is not None and rules.include_rpm.search(name)
 
     def exclude_rpm(self, cls, name):
-        config_for_class = self._config_for_class(cls)
-        if config_for_class is not None and 'exclude' in config_for_class:
-            exclude = config_for_class['exclude']
-            if 'rpm' in exclude:
-                for name_re in exclude['rpm']:
-                    if re.search(name_re, name):
-                        return True
-                return False
-            else:
-                return False
-        else:
-            return False
+        rules = self._rules.get(cls)
+        return rules is not None and rules.exclude_rpm.search(name)
 
     def exclude_any_yum_repos(self, cls, names):
-        config_for_class = self._config_for_class(cls)
-        if config_for_class is not None and 'exclude' in config_for_class:
-            exclude = config_for_class['exclude']
-            if 'yum-repo' in exclude:
-                for name_re in exclude['yum-repo']:
-                    for name in names:
-                        if re.search(name_re, name):
-                            return True
-                return False
-            else:
-                return False
-        else:
-            return False
-
+        rules = self._rules.get(cls)
+        return rules is not None and any(rules.exclude_yum_repo.search(name) for name in names)
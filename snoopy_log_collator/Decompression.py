@@ -0,0 +1,144 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .UserError import UserError
+
+# how much to read from a logfile at a time
+CHUNK_SIZE = 1048576
+
+def open_zstandard(path):
+    if zstandard is None:
+        return None
+    return zstandard.open(path, 'rb')
+
+# for each compressed suffix, how to open it in Python, returning None if
+# that isn't possible, and the external programs which decompress it to
+# stdout, in order of preference
+COMPRESSIONS = {
+    '.gz': (gzip.open, [['pigz', '-dc'], ['gzip', '-dc']]),
+    '.bz2': (bz2.open, [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']]),
+    '.xz': (lzma.open, [['xz', '-dc', '-T0']]),
+    '.zst': (open_zstandard, [['zstd', '-dcq']]),
+}
+
+class DecompressionError(UserError):
+
+    def __init__(self, path, msg):
+        self.path = path
+        self.msg = msg
+
+    def __str__(self):
+        return('Decompression error %s: %s' % (self.path, self.msg))
+
+def compression_suffix(name):
+    """Return the suffix of name if it is that of a compressed file, otherwise ''."""
+    suffix = os.path.splitext(name)[1]
+    return suffix if suffix in COMPRESSIONS else ''
+
+def external_decompressor(suffix):
+    """Return the command for the first external decompressor found for suffix, or None."""
+    for command in COMPRESSIONS[suffix][1]:
+        if shutil.which(command[0]) is not None:
+            return command
+    return None
+
+class ExternalDecompression(object):
+    """The output of an external decompressor, read through a pipe."""
+
+    def __init__(self, command, path):
+        self._path = path
+        self._proc = subprocess.Popen(command + [path], stdout=subprocess.PIPE, bufsize=CHUNK_SIZE)
+        self._eof = False
+
+    def read(self, n=-1):
+        data = self._proc.stdout.read(n)
+        if len(data) == 0 or n < 0:
+            self._eof = True
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if not self._eof:
+            self._proc.kill()
+        self._proc.stdout.close()
+        status = self._proc.wait()
+        if self._eof and status != 0:
+            raise DecompressionError(self._path, 'decompressor failed with status %d' % status)
+
+def open_logfile(path, offset=0, external=False):
+    """Open a logfile, which may be compressed, for reading its uncompressed bytes from offset.
+
+    If external, decompress in an external program where one is available, so
+    that decompression happens in parallel with parsing."""
+    suffix = compression_suffix(path)
+    if suffix == '':
+        f = open(path, 'rb')
+        f.seek(offset)
+        return f
+    opener = COMPRESSIONS[suffix][0]
+    f = None
+    if not external:
+        f = opener(path)
+    if f is None:
+        command = external_decompressor(suffix)
+        if command is not None:
+            f = ExternalDecompression(command, path)
+        elif external:
+            f = opener(path)
+    if f is None:
+        raise DecompressionError(path, 'no way to decompress %s files found' % suffix)
+    try:
+        # compressed streams can't seek, except by reading
+        while offset > 0:
+            skipped = len(f.read(min(offset, CHUNK_SIZE)))
+            if skipped == 0:
+                break
+            offset -= skipped
+    except:
+        f.close()
+        raise
+    return f
+
+def read_lines(f):
+    """Yield the lines of f, reading it in large chunks, and splitting those
+    into lines all at once, which is much faster than reading line by line."""
+    partial = b''
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if len(chunk) == 0:
+            break
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if len(partial) > 0:
+        yield partial
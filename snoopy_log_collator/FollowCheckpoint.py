@@ -0,0 +1,73 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import sys
+
+from .util import write_file_atomically
+
+# how much of the first line identifies a logfile, after rotation and compression
+HEAD_SIZE = 256
+
+class FollowRecord(object):
+    """How far a followed logfile has been collated, identified by its inode
+    while uncompressed, and by its first line thereafter."""
+
+    def __init__(self, inode, offset, head):
+        self.inode = inode
+        self.offset = offset
+        self.head = head
+
+class FollowCheckpoint(object):
+    """A FollowCheckpoint records how far each logfile has been collated in
+    follow mode, so that collation may resume there, and so that the lines
+    already collated are skipped when the logfile is rotated.
+
+    The records are kept in logfile order, one per line, in a text file which
+    is replaced atomically on each save."""
+
+    def __init__(self, path):
+        self._path = path
+        self.records = []
+        try:
+            with open(path) as f:
+                for line in f:
+                    inode_s, offset_s, head_s = line.split()
+                    self.records.append(FollowRecord(int(inode_s), int(offset_s), binascii.unhexlify(head_s)))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            sys.stderr.write('warning: ignoring badly formatted follow checkpoint %s\n' % path)
+            self.records = []
+
+    def find_head(self, data):
+        """Return the record for the logfile whose first bytes are data, if any."""
+        for record in self.records:
+            if data[:len(record.head)] == record.head:
+                return record
+        return None
+
+    def add(self, inode, head):
+        record = FollowRecord(inode, 0, head[:HEAD_SIZE])
+        self.records.append(record)
+        return record
+
+    def remove(self, record):
+        self.records.remove(record)
+        self.save()
+
+    def save(self):
+        write_file_atomically(self._path, ''.join('%d %d %s\n' % (record.inode, record.offset, binascii.hexlify(record.head).decode('ascii'))
+                                                  for record in self.records))
@@ -0,0 +1,94 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import sys
+
+from .util import write_file_atomically
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        return '-'
+
+def file_sizes(paths):
+    """Return the sizes of paths, as required by Journal.record."""
+    sizes = {}
+    for path in paths:
+        try:
+            sizes[path] = os.path.getsize(path)
+        except FileNotFoundError:
+            sizes[path] = -1
+    return sizes
+
+class Journal(object):
+    """A Journal records the sizes of files before appending to them, so that
+    appends which are interrupted before the progress made is recorded in a
+    checkpoint file may be undone.
+
+    The journal is tied to the contents of the checkpoint file when it was
+    written, so once the checkpoint file has changed, the journal is obsolete."""
+
+    def __init__(self, path):
+        self._path = path
+        self._checkpoint_path = None
+
+    def guard(self, checkpoint_path):
+        """Tie subsequent records to the checkpoint file checkpoint_path."""
+        self._checkpoint_path = checkpoint_path
+
+    def record(self, sizes):
+        """Record sizes, a dict of path to size, or -1 for files which don't yet exist."""
+        lines = ['%s %s\n' % (file_digest(self._checkpoint_path), self._checkpoint_path)]
+        lines.extend('%d %s\n' % (size, path) for path, size in sizes.items())
+        write_file_atomically(self._path, ''.join(lines))
+
+    def clear(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def recover(self):
+        """Undo the appends recorded, if the checkpoint file hasn't changed since,
+        returning the paths of the files changed."""
+        try:
+            with open(self._path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        paths = []
+        try:
+            digest, checkpoint_path = lines[0].split(' ', 1)
+            if digest == file_digest(checkpoint_path):
+                sys.stderr.write('warning: undoing %d interrupted appends recorded in %s\n' % (len(lines) - 1, self._path))
+                for line in lines[1:]:
+                    size_s, path = line.split(' ', 1)
+                    size = int(size_s)
+                    try:
+                        if size < 0:
+                            os.remove(path)
+                        else:
+                            os.truncate(path, size)
+                        paths.append(path)
+                    except FileNotFoundError:
+                        pass
+        except (IndexError, ValueError):
+            sys.stderr.write('warning: ignoring badly formatted journal %s\n' % self._path)
+        self.clear()
+        return paths
@@ -13,25 +13,66 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
+from .Compression import file_compression, read_consolidated
+
+# how much of a plain file to read at a time, kept small as many files may be
+# merged at once, rather than the default buffer size of st_blksize, which may
+# be large, e.g. on NFS
+BUFFER_SIZE = 8192
 
 class KeyedReader(object):
+    """A KeyedReader reads the lines of a collated or consolidated file, which
+    may be compressed, with the key of the current line.
+
+    Of a plain file, only the lines from start, and up to end if given, are
+    read, these being offsets of line boundaries."""
 
-    def __init__(self, path, keyfn):
+    def __init__(self, path, keyfn, start=0, end=None):
         self._path = path
-        self._f = open(path, 'r')
+        self._start = start
+        self._end = end
+        self._lines = self._read_lines()
         self._keyfn = keyfn
         self.next()
 
+    def _read_lines(self):
+        if file_compression(self._path) is None:
+            yield from self._read_plain_lines()
+        else:
+            for line in read_consolidated(self._path):
+                yield line.decode('utf-8')
+
+    def _read_plain_lines(self):
+        with open(self._path, 'rb', buffering=0) as f:
+            f.seek(self._start)
+            remaining = None if self._end is None else self._end - self._start
+            partial = b''
+            while remaining is None or remaining > 0:
+                chunk = f.read(BUFFER_SIZE if remaining is None else min(BUFFER_SIZE, remaining))
+                if len(chunk) == 0:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                # decoded in whole lines, as a chunk may end within a character
+                data = partial + chunk
+                i = data.rfind(b'\n') + 1
+                partial = data[i:]
+                lines = data[:i].decode('utf-8').split('\n')
+                # the last is empty, being after the last newline
+                lines.pop()
+                for line in lines:
+                    yield line + '\n'
+            if len(partial) > 0:
+                yield partial.decode('utf-8')
+
     def __str__(self):
         return 'KeyedReader(%s)' % self._path
 
     def next(self):
-        if self._f is not None:
-            self.line = self._f.readline()
+        if self._lines is not None:
+            self.line = next(self._lines, '')
             if self.line != '':
                 self.key = self._keyfn(self.line)
             else:
                 self.key = None
-                self._f.close()
-                self._f = None
+                self._lines = None
@@ -0,0 +1,54 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+
+class KeyedReaderHeap(object):
+    """A KeyedReaderHeap is a heap used for merging lines from KeyedReader's
+    in order of key.  Lines with equal keys are merged in the order their
+    readers were inserted."""
+
+    def __init__(self):
+        # heap entries are (key, insertion index, reader), so ties never compare readers
+        self._heap = []
+        self.n = 0
+        self.lastkey = None
+
+    def __str__(self):
+        return 'KRH(%d, %s)' % (self.n, ', '.join(str(reader) for key, i, reader in sorted(self._heap)))
+
+    def insert(self, reader):
+        if reader.key is not None:
+            heapq.heappush(self._heap, (reader.key, self.n, reader))
+        self.n += 1
+
+    @property
+    def key(self):
+        if len(self._heap) > 0:
+            return self._heap[0][0]
+        else:
+            return None
+
+    def lines(self):
+        heap = self._heap
+        while len(heap) > 0:
+            key, i, reader = heap[0]
+            self.lastkey = key
+            yield reader.line
+            reader.next()
+            if reader.key is not None:
+                heapq.heapreplace(heap, (reader.key, i, reader))
+            else:
+                heapq.heappop(heap)
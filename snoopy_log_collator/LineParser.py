@@ -0,0 +1,83 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+# snoopy's default message_format, which is what the log lines are expected to
+# be unless configured otherwise
+DEFAULT_MESSAGE_FORMAT = '[uid:%{uid} sid:%{sid} tty:%{tty} cwd:%{cwd} filename:%{filename}]: %{cmdline}'
+
+# the snoopy fields which collation needs, and which the message_format must therefore include
+REQUIRED_FIELDS = ['uid', 'cwd', 'filename', 'cmdline']
+
+# the syslog timestamp, hostname, and tag which precede each snoopy message
+SYSLOG_PREFIX = r'(?P<timestamp>\S+\s+\d+\s+\d+:\d+:\d+)\s+\S+\s+\S+\[\d+\]:\s+'
+
+FIELD_RE = re.compile(r'%\{([^}]*)\}')
+WHITESPACE_RE = re.compile(r'(\s+)')
+
+def message_format_regex(message_format):
+    """Return the regex for the log lines written with a snoopy message_format,
+    with a group for the timestamp and each of REQUIRED_FIELDS.
+
+    As snoopy doesn't quote field values, which may contain spaces, each field
+    matches as little as possible before the text which follows it.  Raises
+    ValueError if the message_format lacks any of REQUIRED_FIELDS."""
+    # parts alternate between literal text and field names
+    parts = FIELD_RE.split(message_format)
+    pattern = [SYSLOG_PREFIX]
+    groups = set()
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            pattern.extend(r'\s+' if s.isspace() else re.escape(s) for s in WHITESPACE_RE.split(part) if s != '')
+        else:
+            if part in REQUIRED_FIELDS and part not in groups:
+                groups.add(part)
+                group = '(?P<%s>' % part
+            else:
+                group = '(?:'
+            # a field at the end runs to the end of the line
+            last = i == len(parts) - 2 and parts[-1] == ''
+            pattern.append(group + ('.*)' if last else '.*?)'))
+    missing = [field for field in REQUIRED_FIELDS if field not in groups]
+    if len(missing) > 0:
+        raise ValueError('no %s' % ', '.join('%%{%s}' % field for field in missing))
+    pattern.append('$')
+    return re.compile(''.join(pattern).encode('utf-8'))
+
+class LineParser(object):
+    """A LineParser extracts from a snoopy log line just what collation needs,
+    in a single regex match on the undecoded line, so that only those fields
+    are decoded, and lines which don't match aren't decoded at all."""
+
+    def __init__(self, message_format=DEFAULT_MESSAGE_FORMAT):
+        self._match = message_format_regex(message_format).match
+
+    def parse(self, line):
+        """Return the syslog timestamp, the uid, cwd, and filename fields as a
+        dict, and the command, for a line as bytes, or None if the line
+        doesn't match.
+
+        Raises UnicodeDecodeError if any of those are not UTF-8."""
+        m = self._match(line)
+        if m is None:
+            return None
+        timestamp, uid, cwd, filename, command = m.group('timestamp', 'uid', 'cwd', 'filename', 'cmdline')
+        fields = {
+            'uid': uid.decode('utf-8'),
+            'cwd': cwd.decode('utf-8'),
+            'filename': filename.decode('utf-8'),
+        }
+        return timestamp.decode('utf-8'), fields, command.decode('utf-8').rstrip()
@@ -0,0 +1,266 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import heapq
+import itertools
+import os
+import os.path
+import pickle
+import sqlite3
+import tempfile
+
+from .Compression import file_compression, read_members
+from .Stats import stats
+from .UserError import UserError
+from .util import last_line, line_timestamp
+
+# how much of a file to read at a time when counting its lines
+CHUNK_SIZE = 1048576
+
+# how many entries a ManifestSnapshot holds in memory at a time
+SNAPSHOT_BATCH_SIZE = 4096
+
+ManifestEntry = collections.namedtuple('ManifestEntry', ['host', 'relpath', 'size', 'lines', 'last', 'consolidated', 'consolidated_lines'])
+
+# selects ManifestEntry rows, with nothing consolidated for a file not in the consolidated table
+ENTRY_SELECT = 'SELECT f.host, f.relpath, f.size, f.lines, f.last, IFNULL(c.size, 0), IFNULL(c.lines, 0) FROM files f LEFT JOIN consolidated c ON c.cls = f.cls AND c.host = f.host AND c.relpath = f.relpath'
+
+class ManifestError(UserError):
+
+    def __init__(self, path, msg):
+        self.path = path
+        self.msg = msg
+
+    def __str__(self):
+        return('Manifest error %s: %s' % (self.path, self.msg))
+
+def summarize_file(path):
+    """Return the size, number of lines, and last timestamp of a collated or
+    consolidated file, the size of a compressed file being its compressed size."""
+    compression = file_compression(path)
+    if compression is not None:
+        return _summarize_compressed_file(path, compression)
+    n_lines = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            n_lines += chunk.count(b'\n')
+        size = f.tell()
+    last = line_timestamp(last_line(path)) if size > 0 else ''
+    return size, n_lines, last
+
+def _summarize_compressed_file(path, compression):
+    n_lines = 0
+    last = b''
+    with open(path, 'rb') as f:
+        for start, end, data in read_members(f, path, compression):
+            n_lines += data.count(b'\n')
+            if len(data) > 0:
+                last = data
+        size = f.tell()
+    # the last line is always within the last member, as members are of whole lines
+    lastline = last[last.rfind(b'\n', 0, len(last) - 1) + 1:]
+    return size, n_lines, line_timestamp(lastline).decode('utf-8')
+
+def scan_tree(top):
+    """Yield the relpath and path of every file below top, in no particular order."""
+    stack = [('', top)]
+    while len(stack) > 0:
+        prefix, dirpath = stack.pop()
+        try:
+            with os.scandir(dirpath) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append((prefix + e.name + '/', e.path))
+                    else:
+                        yield prefix + e.name, e.path
+        except FileNotFoundError:
+            pass
+
+class Manifest(object):
+    """A Manifest records collated or consolidated files in an SQLite database,
+    so that they may be listed without walking the directories.
+
+    Each file is keyed by class, host and relpath, and has its size, number
+    of lines, and the timestamp of its last line.  A collated file which grew
+    while being consolidated is left in place, and the size and number of lines
+    of its head which was consolidated are recorded, so that only the rest is
+    consolidated next time.  A manifest which has never
+    been built, or whose update was interrupted, is stale, and must be rebuilt
+    by walking the directories."""
+
+    def __init__(self, path):
+        self._path = path
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS files (cls TEXT, host TEXT, relpath TEXT, size INTEGER, lines INTEGER, last TEXT, PRIMARY KEY (cls, host, relpath))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS consolidated (cls TEXT, host TEXT, relpath TEXT, size INTEGER, lines INTEGER, PRIMARY KEY (cls, host, relpath))')
+        self._db.commit()
+
+    @property
+    def stale(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'state'").fetchone()
+        return row is None or row[0] != 'ok'
+
+    def _set_state(self, state):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('state', ?)", (state,))
+        self._db.commit()
+
+    def begin_update(self):
+        """Mark the manifest as stale until end_update, for updates which can't be made in a single transaction."""
+        self._set_state('updating')
+
+    def end_update(self):
+        self._set_state('ok')
+
+    def rebuild(self, trees):
+        """Replace the contents with the files found by walking trees, a list of (cls, host, dir)."""
+        with stats.timer('manifest: rebuild'):
+            entries = []
+            for cls, host, top in trees:
+                for relpath, path in scan_tree(top):
+                    # the last collation used to be recorded in the collated files,
+                    # and a merge in progress or interrupted leaves a .new file
+                    if relpath != '.collated' and not (host == 'ALL' and relpath.endswith('.new')):
+                        entries.append((cls, host, relpath) + summarize_file(path))
+            self._db.execute('DELETE FROM files')
+            self._db.executemany('INSERT INTO files (cls, host, relpath, size, lines, last) VALUES (?, ?, ?, ?, ?, ?)', entries)
+            # what was consolidated is kept, unless the file is no longer there to have it
+            self._db.execute('DELETE FROM consolidated WHERE NOT EXISTS (SELECT 1 FROM files f WHERE f.cls = consolidated.cls AND f.host = consolidated.host AND f.relpath = consolidated.relpath AND f.size >= consolidated.size)')
+            self._set_state('ok')
+        stats.count('manifest: files rebuilt', len(entries))
+
+    def files(self, cls, host=None):
+        """Yield the entries for cls, and only for host if given, in order of relpath.
+
+        The manifest mustn't be changed until these have all been read."""
+        if host is None:
+            rows = self._db.execute('%s WHERE f.cls = ? ORDER BY f.relpath, f.host' % ENTRY_SELECT, (cls,))
+        else:
+            rows = self._db.execute('%s WHERE f.cls = ? AND f.host = ? ORDER BY f.relpath' % ENTRY_SELECT, (cls, host))
+        for row in rows:
+            yield ManifestEntry(*row)
+
+    def get(self, cls, host, relpath):
+        """Return the entry for a file, or None if there is none."""
+        row = self._db.execute('%s WHERE f.cls = ? AND f.host = ? AND f.relpath = ?' % ENTRY_SELECT, (cls, host, relpath)).fetchone()
+        return ManifestEntry(*row) if row is not None else None
+
+    def put(self, cls, host, relpath, size, lines, last):
+        """Record a file as having been written afresh."""
+        self._db.execute('INSERT OR REPLACE INTO files (cls, host, relpath, size, lines, last) VALUES (?, ?, ?, ?, ?, ?)',
+                         (cls, host, relpath, size, lines, last))
+
+    def append(self, cls, host, relpath, size, lines, last):
+        """Record lines having been appended to a file, which is created if it doesn't exist."""
+        # not an upsert, which needs SQLite 3.24, later than EL7 has
+        cursor = self._db.execute('UPDATE files SET size = size + ?, lines = lines + ?, last = ? WHERE cls = ? AND host = ? AND relpath = ?',
+                                  (size, lines, last, cls, host, relpath))
+        if cursor.rowcount == 0:
+            self._db.execute('INSERT INTO files (cls, host, relpath, size, lines, last) VALUES (?, ?, ?, ?, ?, ?)',
+                             (cls, host, relpath, size, lines, last))
+
+    def remove(self, cls, host, relpath):
+        self._db.execute('DELETE FROM files WHERE cls = ? AND host = ? AND relpath = ?', (cls, host, relpath))
+        self._db.execute('DELETE FROM consolidated WHERE cls = ? AND host = ? AND relpath = ?', (cls, host, relpath))
+
+    def set_consolidated(self, cls, host, relpath, size, lines):
+        """Record that the first size bytes and lines of a collated file have been consolidated."""
+        self._db.execute('INSERT OR REPLACE INTO consolidated (cls, host, relpath, size, lines) VALUES (?, ?, ?, ?, ?)',
+                         (cls, host, relpath, size, lines))
+
+    def refresh(self, cls, host, relpath, path):
+        """Record the file at path as it is now, e.g. after an append to it was undone."""
+        try:
+            self.put(cls, host, relpath, *summarize_file(path))
+        except FileNotFoundError:
+            self.remove(cls, host, relpath)
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+class ManifestSnapshot(object):
+    """A ManifestSnapshot is the entries for a class in the manifests of several
+    hosts at one time, merged in order of relpath.
+
+    The entries are spooled to a temporary file in batches, so that they may be
+    streamed more than once, in bounded memory."""
+
+    def __init__(self, cls, manifests):
+        """manifests is a dict of host to the Manifest of files collated there."""
+        self._f = tempfile.TemporaryFile()
+        self.hosts = list(manifests.keys())
+        streams = [manifest.files(cls, host) for host, manifest in manifests.items()]
+        batch = []
+        for entry in heapq.merge(*streams, key=lambda entry: entry.relpath):
+            batch.append(entry)
+            if len(batch) >= SNAPSHOT_BATCH_SIZE:
+                pickle.dump(batch, self._f)
+                batch = []
+        if len(batch) > 0:
+            pickle.dump(batch, self._f)
+
+    def entries(self):
+        """Yield all the entries, in order of relpath."""
+        self._f.seek(0)
+        while True:
+            try:
+                batch = pickle.load(self._f)
+            except EOFError:
+                break
+            yield from batch
+
+    def relpaths(self):
+        """Yield each relpath in order, with the entries for it which have
+        anything not yet consolidated, skipping relpaths with none."""
+        for relpath, entries in itertools.groupby(self.entries(), key=lambda entry: entry.relpath):
+            entries = [entry for entry in entries if entry.size > entry.consolidated]
+            if len(entries) > 0:
+                yield relpath, entries
+
+    def close(self):
+        self._f.close()
+
+def _open_manifest(path, trees, rebuild):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        manifest = Manifest(path)
+        if rebuild or manifest.stale:
+            manifest.rebuild(trees)
+        return manifest
+    except (OSError, sqlite3.Error) as e:
+        raise ManifestError(path, str(e))
+
+def open_collation_manifest(config, host, rebuild=False):
+    """Open the Manifest of the files collated for host, rebuilding it if asked or stale."""
+    trees = [(cls, host, config.host_collation_dir(cls, host)) for cls in config.classes_with_all]
+    return _open_manifest(config.collation_manifest_file(host), trees, rebuild)
+
+def open_consolidation_manifest(config, rebuild=False):
+    """Open the Manifest of the consolidated files, rebuilding it if asked or stale.
+
+    Files consolidated across all hosts have the host ALL."""
+    trees = []
+    for cls in config.classes:
+        trees.append((cls, 'ALL', config.consolidation_dir(cls)))
+        trees.extend((cls, host, config.consolidation_dir(cls, host)) for host in config.consolidated_hosts(cls))
+    return _open_manifest(config.consolidation_manifest_file, trees, rebuild)
@@ -18,16 +18,35 @@ import os
 import os.path
 import pwd
 import re
+import stat
 import subprocess
 import sys
 
+from .Stats import stats
+
+# returned by the _cached methods when the cache doesn't have a value, which may be None
+UNKNOWN = object()
+
 class Mapper(object):
-    def __init__(self):
+    def __init__(self, cache=None, bulk=False):
+        self._cache = cache
+        self._bulk = bulk
+        self._rpm_index = None
+        self._yum_repos_index = None
         self._rpm_by_path = {}
         self._yum_repos_by_rpm = {}
         self._username = {}
         self._isfile = {}
         self._excluded = {}
+        # what the cache has been found not to have, so it isn't looked up again
+        self._rpm_uncached = set()
+        self._yum_repos_uncached = set()
+        # the futures of queries started by prefetch, of the rpm queries whose
+        # packages may also need their yum repos prefetched, and the paths prefetched
+        self._rpm_queries = {}
+        self._yum_repos_queries = {}
+        self._prefetching_rpm = {}
+        self._prefetch_seen = set()
 
     def username(self, uid):
         if uid not in self._username:
@@ -50,44 +69,178 @@ class Mapper(object):
             self._isfile[path] = isfile
         return isfile
 
+    def _cached(self, kind, key):
+        """Look up the persistent cache, raising KeyError if not found."""
+        if self._cache is None:
+            raise KeyError(key)
+        return self._cache.get(kind, key)
+
+    def _cache_put(self, kind, key, value):
+        if self._cache is not None:
+            self._cache.put(kind, key, value)
+
+    def commit_cache(self):
+        if self._cache is not None:
+            self._cache.commit()
+
+    def close(self):
+        if self._cache is not None:
+            self._cache.close()
+
+    def write_stats(self, f):
+        if self._cache is not None:
+            self._cache.write_stats(f)
+
+    def _cached_rpm(self, path):
+        if path in self._rpm_uncached:
+            return UNKNOWN
+        try:
+            return self._cached('rpm', path)
+        except KeyError:
+            self._rpm_uncached.add(path)
+            return UNKNOWN
+
+    def _query_rpm(self, path):
+        package = None
+        if os.path.exists(path):
+            if self._bulk:
+                package = self._indexed_rpm(path)
+            else:
+                stats.count('rpm -qf: calls')
+                with stats.timer('rpm -qf'):
+                    rpm = subprocess.Popen(["rpm", "-qf", "--qf", "%{NAME}\n", path], stdout = subprocess.PIPE, universal_newlines=True)
+                    line = rpm.stdout.readline().rstrip('\n')
+                if not line.endswith('is not owned by any package'):
+                    package = line
+        return package
+
     def rpm(self, path):
         if path in self._rpm_by_path:
             package = self._rpm_by_path[path]
         else:
-            package = None
-            if os.path.exists(path):
-                rpm = subprocess.Popen(["rpm", "-qf", "--qf", "%{NAME}\n", path], stdout = subprocess.PIPE, universal_newlines=True)
-                line = rpm.stdout.readline().rstrip('\n')
-                if not line.endswith('is not owned by any package'):
-                    package = line
+            package = self._cached_rpm(path)
+            if package is UNKNOWN:
+                package = self._prefetched(self._rpm_queries, path, self._query_rpm)
+                self._cache_put('rpm', path, package)
             self._rpm_by_path[path] = package
         return package
 
-    def yum_repos(self, rpm):
-        if rpm in self._yum_repos_by_rpm:
-            repos = self._yum_repos_by_rpm[rpm]
+    def _build_rpm_index(self):
+        """Index the packages owning all executables and symlinks, with a single rpm query."""
+        self._rpm_index = {}
+        stats.count('rpm -qa: calls')
+        with stats.timer('rpm -qa'):
+            rpm = subprocess.Popen(["rpm", "-qa", "--qf", "[%{FILEMODES}\t%{FILENAMES}\t%{NAME}\n]"], stdout = subprocess.PIPE, universal_newlines=True)
+            for line in rpm.stdout:
+                toks = line.rstrip('\n').split('\t')
+                if len(toks) == 3:
+                    # FILEMODES is a 16 bit quantity, which some versions of rpm print as signed
+                    mode = int(toks[0]) & 0xffff
+                    if (stat.S_ISREG(mode) and mode & 0o111) or stat.S_ISLNK(mode):
+                        # where several packages own a file, rpm -qf reports the first
+                        if toks[1] not in self._rpm_index:
+                            self._rpm_index[toks[1]] = toks[2]
+            rpm.wait()
+
+    def _indexed_rpm(self, path):
+        if self._rpm_index is None:
+            self._build_rpm_index()
+        if path in self._rpm_index:
+            return self._rpm_index[path]
         else:
-            repos = set()
+            # like rpm -qf, resolve any symlinked directories, e.g. /bin -> /usr/bin
+            dirname, basename = os.path.split(path)
+            return self._rpm_index.get(os.path.join(os.path.realpath(dirname), basename))
+
+    def _build_yum_repos_index(self):
+        """Index the repos of all installed packages, with a single yum query.
+
+        As with yum info, each package's repos are installed and the repo it
+        was installed from."""
+        self._yum_repos_index = {}
+        # each package is listed as package.arch, version, and @repo, though
+        # long package names cause yum to wrap the line, continuing it indented
+        entries = []
+        listing = False
+        stats.count('yum list installed: calls')
+        with stats.timer('yum list installed'):
+            yum = subprocess.Popen(["yum", "list", "installed"], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, universal_newlines=True)
+            for line in yum.stdout:
+                if listing:
+                    if line[:1].isspace() and len(entries) > 0:
+                        entries[-1].extend(line.split())
+                    else:
+                        entries.append(line.split())
+                elif line.startswith('Installed Packages'):
+                    listing = True
+            yum.wait()
+        for toks in entries:
+            if len(toks) != 3:
+                sys.stderr.write('warning: ignoring unexpected yum list installed line %s\n' % ' '.join(toks))
+                continue
+            name = toks[0].rsplit('.', 1)[0]
+            if name not in self._yum_repos_index:
+                self._yum_repos_index[name] = set(['installed'])
+            self._yum_repos_index[name].add(toks[2].lstrip('@'))
+
+    def _query_yum_repos(self, rpm):
+        repos = set()
+        stats.count('yum info: calls')
+        with stats.timer('yum info'):
             yum = subprocess.Popen(["yum", "info", rpm], stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines=True)
             for line in yum.stdout:
                 m = re.match(r"""(From )?[Rr]epo\s*:\s*(\S*)""", line)
                 if m:
                     repos.add(m.group(2))
-            if len(repos) == 0:
-                errorline = yum.stderr.read()
-                if errorline.startswith('Error'):
-                    sys.stderr.write('Mapper::yum_repo(%s) %s' % (rpm, errorline))
+        if len(repos) == 0:
+            errorline = yum.stderr.read()
+            if errorline.startswith('Error'):
+                sys.stderr.write('Mapper::yum_repo(%s) %s' % (rpm, errorline))
+        return repos
+
+    def _cached_yum_repos(self, rpm):
+        if rpm in self._yum_repos_uncached:
+            return UNKNOWN
+        try:
+            return self._cached('yum-repos', rpm)
+        except KeyError:
+            self._yum_repos_uncached.add(rpm)
+            return UNKNOWN
+
+    def yum_repos(self, rpm):
+        if rpm in self._yum_repos_by_rpm:
+            repos = self._yum_repos_by_rpm[rpm]
+        else:
+            repos = self._cached_yum_repos(rpm)
+            if repos is UNKNOWN:
+                if self._bulk:
+                    if self._yum_repos_index is None:
+                        self._build_yum_repos_index()
+                    repos = self._yum_repos_index.get(rpm)
+                else:
+                    repos = None
+                if repos is None:
+                    repos = self._prefetched(self._yum_repos_queries, rpm, self._query_yum_repos)
+                self._cache_put('yum-repos', rpm, repos)
             self._yum_repos_by_rpm[rpm] = repos
         return repos
 
-    def excluded(self, path, cls, config):
-        """Look up config and return whether this path is excluded for cls."""
+    def _cached_excluded(self, path, cls):
+        """Return whether path is excluded for cls, if that is memoized or cached, otherwise None."""
         if cls not in self._excluded:
             self._excluded[cls] = {}
         excluded_for_class = self._excluded[cls]
-        if path in excluded_for_class:
-            return excluded_for_class[path]
-        else:
+        if path not in excluded_for_class:
+            try:
+                excluded_for_class[path] = self._cached('excluded', (cls, path))
+            except KeyError:
+                excluded_for_class[path] = None
+        return excluded_for_class[path]
+
+    def excluded(self, path, cls, config):
+        """Look up config and return whether this path is excluded for cls."""
+        excluded = self._cached_excluded(path, cls)
+        if excluded is None:
             if config.exclude_file(cls, path):
                 excluded = True
             else:
@@ -106,5 +259,65 @@ class Mapper(object):
                         excluded = True
                     else:
                         excluded = False
-            excluded_for_class[path] = excluded
+            self._cache_put('excluded', (cls, path), excluded)
+            self._excluded[cls][path] = excluded
         return excluded
+
+    def _prefetched(self, queries, key, query):
+        """Return the result of query for key, from its future if it was prefetched."""
+        future = queries.pop(key, None)
+        if future is not None and not future.cancelled():
+            return future.result()
+        return query(key)
+
+    def prefetch(self, path, config, executor):
+        """Start on executor the rpm query which looking up whether path is
+        excluded would need, if any, so that it runs while other lines are collated.
+
+        The yum query for the package, if needed, is started by a later
+        prefetch, once the rpm query is done.  Nothing is queried which
+        wouldn't be otherwise, and in bulk mode nothing is prefetched, as
+        there are few queries."""
+        if self._bulk:
+            return
+        for prefetching, (future, classes) in list(self._prefetching_rpm.items()):
+            if future.done():
+                del self._prefetching_rpm[prefetching]
+                if not future.cancelled() and future.exception() is None:
+                    self._prefetch_yum_repos(future.result(), classes, config, executor)
+        if path in self._prefetch_seen:
+            return
+        self._prefetch_seen.add(path)
+        if path in self._rpm_by_path or not self.isfile(path):
+            return
+        classes = [cls for cls in config.classes_with_all if self._cached_excluded(path, cls) is None and not config.exclude_file(cls, path)]
+        if len(classes) == 0:
+            return
+        package = self._cached_rpm(path)
+        if package is UNKNOWN:
+            future = executor.submit(self._query_rpm, path)
+            self._rpm_queries[path] = future
+            self._prefetching_rpm[path] = (future, classes)
+        else:
+            self._rpm_by_path[path] = package
+            self._prefetch_yum_repos(package, classes, config, executor)
+
+    def _prefetch_yum_repos(self, rpm, classes, config, executor):
+        if rpm is None or rpm in self._yum_repos_by_rpm or rpm in self._yum_repos_queries:
+            return
+        if all(config.include_rpm(cls, rpm) or config.exclude_rpm(cls, rpm) for cls in classes):
+            return
+        repos = self._cached_yum_repos(rpm)
+        if repos is UNKNOWN:
+            self._yum_repos_queries[rpm] = executor.submit(self._query_yum_repos, rpm)
+        else:
+            self._yum_repos_by_rpm[rpm] = repos
+
+    def end_prefetch(self):
+        """Cancel and forget any prefetched queries not yet used, before their executor is shut down."""
+        for future in list(self._rpm_queries.values()) + list(self._yum_repos_queries.values()):
+            future.cancel()
+        self._prefetch_seen = set()
+        self._rpm_queries = {}
+        self._yum_repos_queries = {}
+        self._prefetching_rpm = {}
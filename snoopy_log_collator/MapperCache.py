@@ -0,0 +1,143 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import os.path
+import sqlite3
+import sys
+
+from .Stats import stats
+
+RPMDB_DIR = '/var/lib/rpm'
+
+# changed whenever what is cached changes, to discard what was cached before
+CACHE_FORMAT = '2'
+
+# the files which change when packages are installed or removed,
+# for the various rpmdb backends
+RPMDB_FILES = ['Packages', 'Packages.db', 'rpmdb.sqlite', 'rpmdb.sqlite-wal']
+
+def rpmdb_fingerprint():
+    """A fingerprint of the rpm database, which changes whenever packages are installed or removed."""
+    stats = []
+    for filename in RPMDB_FILES:
+        try:
+            st = os.stat(os.path.join(RPMDB_DIR, filename))
+            stats.append('%s:%d:%d' % (filename, st.st_mtime_ns, st.st_size))
+        except OSError:
+            pass
+    return ' '.join(stats)
+
+class MapperCache(object):
+    """A MapperCache persists Mapper lookups across runs, in an SQLite database.
+
+    Package lookups are discarded whenever the rpm database changes, and
+    exclusions are also discarded whenever the include/exclude rules change.
+
+    If write_through, values put are committed at once, so that other
+    processes using the same cache, e.g. parallel workers, see them."""
+
+    KINDS = ['rpm', 'yum-repos', 'excluded']
+
+    def __init__(self, path, rules_digest, write_through=False):
+        self._path = path
+        self._write_through = write_through
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS rpm (path TEXT PRIMARY KEY, package TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS yum_repos (rpm TEXT PRIMARY KEY, repos TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS excluded (cls TEXT, path TEXT, excluded INTEGER, PRIMARY KEY (cls, path))')
+        self._invalidate_if_changed('format', CACHE_FORMAT, ['yum_repos', 'excluded'])
+        self._invalidate_if_changed('rpmdb', rpmdb_fingerprint(), ['rpm', 'yum_repos', 'excluded'])
+        self._invalidate_if_changed('rules', rules_digest, ['excluded'])
+        self._db.commit()
+        self._pending = {kind: {} for kind in self.KINDS}
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def _invalidate_if_changed(self, key, value, tables):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None or row[0] != value:
+            for table in tables:
+                self._db.execute('DELETE FROM %s' % table)
+            self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def _lookup(self, kind, key):
+        if kind == 'rpm':
+            row = self._db.execute('SELECT package FROM rpm WHERE path = ?', (key,)).fetchone()
+        elif kind == 'yum-repos':
+            row = self._db.execute('SELECT repos FROM yum_repos WHERE rpm = ?', (key,)).fetchone()
+        else:
+            cls, path = key
+            row = self._db.execute('SELECT excluded FROM excluded WHERE cls = ? AND path = ?', (cls, path)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        elif kind == 'yum-repos':
+            return set(row[0].split())
+        elif kind == 'excluded':
+            return bool(row[0])
+        else:
+            return row[0]
+
+    def get(self, kind, key):
+        """Return the cached value for key, or raise KeyError."""
+        try:
+            if key in self._pending[kind]:
+                value = self._pending[kind][key]
+            else:
+                value = self._lookup(kind, key)
+        except KeyError:
+            self.misses[kind] += 1
+            raise
+        self.hits[kind] += 1
+        return value
+
+    def put(self, kind, key, value):
+        self._pending[kind][key] = value
+        if self._write_through:
+            self.commit()
+
+    def commit(self):
+        """Write the values put since the last commit."""
+        self._db.executemany('INSERT OR REPLACE INTO rpm (path, package) VALUES (?, ?)',
+                             self._pending['rpm'].items())
+        self._db.executemany('INSERT OR REPLACE INTO yum_repos (rpm, repos) VALUES (?, ?)',
+                             ((rpm, ' '.join(sorted(repos))) for rpm, repos in self._pending['yum-repos'].items()))
+        self._db.executemany('INSERT OR REPLACE INTO excluded (cls, path, excluded) VALUES (?, ?, ?)',
+                             ((cls, path, int(excluded)) for (cls, path), excluded in self._pending['excluded'].items()))
+        self._db.commit()
+        self._pending = {kind: {} for kind in self.KINDS}
+
+    def close(self):
+        self.commit()
+        self._db.close()
+        for kind in self.KINDS:
+            stats.count('mapper cache %s: hits' % kind, self.hits[kind])
+            stats.count('mapper cache %s: misses' % kind, self.misses[kind])
+
+    def write_stats(self, f):
+        for kind in self.KINDS:
+            f.write('mapper cache %s: %d hits, %d misses\n' % (kind, self.hits[kind], self.misses[kind]))
+
+def open_mapper_cache(config, write_through=False):
+    """Open the MapperCache for the local host, or return None if that isn't possible."""
+    path = config.mapper_cache_file
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return MapperCache(path, config.rules_digest, write_through)
+    except (OSError, sqlite3.Error) as e:
+        sys.stderr.write('warning: not using mapper cache %s: %s\n' % (path, e))
+        return None
@@ -13,66 +13,117 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import fnmatch
 import os
 import os.path
 import sys
 
+from .ColumnarExport import ExportWriter
+from .Compression import compress_file, file_compression, open_consolidated, read_consolidated, read_members
 from .Config import Config
+from .Decompression import read_lines
+from .Manifest import ManifestSnapshot, open_collation_manifest, open_consolidation_manifest
 from .Mapper import Mapper
+from .MapperCache import open_mapper_cache
+from .Stats import stats
+from .TimestampIndex import INDEX_INTERVAL, TimestampIndex
 from .KeyedReader import KeyedReader
-from .KeyedReaderTree import KeyedReaderTree
-from .util import bare_hostname, append_and_set_timestamp, timestamp_from_str
+from .KeyedReaderHeap import KeyedReaderHeap
+from .util import append_file, bare_hostname, compact_lines, line_timestamp, move_or_append, set_timestamps, split_count_bytes, timestamp_from_str
+
+# how many rows to buffer before writing a segment of the export file
+EXPORT_SEGMENT_ROWS = 1048576
 
 class PostProcessor(object):
 
     def __init__(self, args):
+        self._args = args
         self._config = Config(args)
-        self._mapper = Mapper()
+        self._mapper = None
+        self._manifests = {}
+
+    def _open_mapper(self):
+        self._mapper = Mapper(open_mapper_cache(self._config), bulk=self._args.bulk)
+
+    def _close_mapper(self):
+        self._mapper.close()
+        if self._args.verbose:
+            self._mapper.write_stats(sys.stderr)
+
+    def _collation_manifest(self, host):
+        if host not in self._manifests:
+            self._manifests[host] = open_collation_manifest(self._config, host, self._args.rebuild_manifest)
+        return self._manifests[host]
+
+    def _consolidation_manifest(self):
+        # None can't be a host, so is used for the consolidation manifest
+        if None not in self._manifests:
+            self._manifests[None] = open_consolidation_manifest(self._config, self._args.rebuild_manifest)
+        return self._manifests[None]
+
+    def _close_manifests(self):
+        for manifest in self._manifests.values():
+            manifest.close()
+        self._manifests = {}
 
     def _get_collated_files(self, cls, host, paths):
-        collationdir = self._config.host_collation_dir(cls, host)
-        n = len(collationdir)
-        for root, dirs, files in os.walk(collationdir):
-            for filename in files:
-                path = os.path.join(root, filename)[n:]
-                if path != '/.collated':
-                    if path not in paths:
-                        paths[path] = set()
-                    paths[path].add(host)
+        for entry in self._collation_manifest(host).files(cls, host):
+            path = '/' + entry.relpath
+            if path not in paths:
+                paths[path] = set()
+            paths[path].add(host)
 
     def list_packages(self, classes):
         paths = {}
-        for cls in classes if len(classes) > 0 else ['all']:
-            self._get_collated_files(cls, bare_hostname(), paths)
-        for path in sorted(paths.keys()):
-            package = self._mapper.rpm(path)
-            repos = self._mapper.yum_repos(package) if package is not None else None
-            if package is not None:
-                print('%s:%s:%s' % (path, str(package), str(repos)))
+        try:
+            for cls in classes if len(classes) > 0 else ['all']:
+                self._get_collated_files(cls, bare_hostname(), paths)
+        finally:
+            self._close_manifests()
+        self._open_mapper()
+        try:
+            for path in sorted(paths.keys()):
+                package = self._mapper.rpm(path)
+                repos = self._mapper.yum_repos(package) if package is not None else None
+                if package is not None:
+                    print('%s:%s:%s' % (path, str(package), str(repos)))
+        finally:
+            self._close_mapper()
 
     def list_files(self, classes):
         paths = {}
-        for cls in classes if len(classes) > 0 else ['all']:
-            for host in self._config.collated_hosts(cls):
-                self._get_collated_files(cls, host, paths)
+        try:
+            for cls in classes if len(classes) > 0 else ['all']:
+                for host in self._config.collated_hosts(cls):
+                    self._get_collated_files(cls, host, paths)
+        finally:
+            self._close_manifests()
         for path in sorted(paths.keys()):
             print('%s %s' % (path, ','.join(sorted(list(paths[path])))))
 
     def list_excluded(self, classes, purge=False):
         paths = {}
-        for cls in classes if len(classes) > 0 else ['all']:
-            root = self._config.localhost_collation_dir(cls)
-            self._get_collated_files(cls, bare_hostname(), paths)
-            for path in paths:
-                if self._mapper.excluded(path, cls, self._config):
-                    if purge:
-                        filepath = os.path.join(root, os.path.relpath(path, '/'))
-                        print('rm %s' % filepath)
-                        os.remove(filepath)
-                    else:
-                        print(path)
-            if purge:
-                self._purge_empty_dirs(cls)
+        self._open_mapper()
+        try:
+            for cls in classes if len(classes) > 0 else ['all']:
+                root = self._config.localhost_collation_dir(cls)
+                self._get_collated_files(cls, bare_hostname(), paths)
+                for path in paths:
+                    if self._mapper.excluded(path, cls, self._config):
+                        if purge:
+                            filepath = os.path.join(root, os.path.relpath(path, '/'))
+                            print('rm %s' % filepath)
+                            os.remove(filepath)
+                            self._collation_manifest(bare_hostname()).remove(cls, bare_hostname(), path[1:])
+                        else:
+                            print(path)
+                if purge:
+                    self._collation_manifest(bare_hostname()).commit()
+                    self._purge_empty_dirs(cls)
+        finally:
+            self._close_mapper()
+            self._close_manifests()
 
     def _purge_empty_dirs(self, cls):
         for root, dirs, files in os.walk(self._config.localhost_collation_dir(cls), topdown=False):
@@ -86,63 +137,336 @@ class PostProcessor(object):
 
     @classmethod
     def timestamp(cls, line):
-        """Return just the timestamp from a line in a collated file."""
-        return timestamp_from_str(line.split(maxsplit=1)[0])
+        """Return just the timestamp from a line in a collated file, as a string,
+        without any repeat count.
+
+        The timestamp format is such that these sort correctly as strings."""
+        return line_timestamp(line)
 
     def consolidate(self):
-        for cls in self._config.classes:
-            hosts = self._config.collated_hosts(cls)
-            all_relpaths = {}
-            for host in hosts:
-                collationdir = self._config.host_collation_dir(cls, host)
-                n = len(collationdir) + 1
-                for root, dirs, files in os.walk(collationdir):
-                    for filename in files:
-                        relpath = os.path.join(root, filename)[n:]
-                        if relpath not in all_relpaths:
-                            all_relpaths[relpath] = []
-                        all_relpaths[relpath].append(host)
-            for relpath, hosts in all_relpaths.items():
-                krt = KeyedReaderTree()
-                inpaths = [os.path.join(self._config.host_collation_dir(cls, host), relpath) for host in hosts]
-                outpath = os.path.join(self._config.consolidation_dir(cls), relpath)
-                for inpath in inpaths:
-                    krt.insert(KeyedReader(inpath, self.__class__.timestamp))
-                if os.path.exists(outpath):
-                    krt.insert(KeyedReader(outpath, self.__class__.timestamp))
-                os.makedirs(os.path.dirname(outpath), exist_ok=True)
-                outpathnew = '%s.new' % outpath
-                with open(outpathnew, 'w') as f:
-                    for line in krt.lines():
-                        f.write(line)
-                os.rename(outpathnew, outpath)
-                # set the timestamp according to the last key
-                t = krt.lastkey.int_timestamp
-                os.utime(outpath, (t, t))
-            self._finalize_consolidated(cls)
-
-    def _finalize_consolidated(self, cls):
-        """Ensure the collated files don't get consolidated again, by moving them."""
-        hosts = self._config.collated_hosts(cls)
-        all_relpaths = {}
-        for host in hosts:
-            collationdir = self._config.host_collation_dir(cls, host)
-            n = len(collationdir) + 1
-            for root, dirs, files in os.walk(collationdir, topdown=False):
-                for filename in files:
-                    relpath = os.path.join(root, filename)[n:]
-                    inpath = os.path.join(collationdir, relpath)
-                    outpath = os.path.join(self._config.consolidation_dir(cls, host), relpath)
-                    os.makedirs(os.path.dirname(outpath), exist_ok=True)
-                    if not os.path.exists(outpath):
-                        os.rename(inpath, outpath)
+        try:
+            consolidated = self._consolidation_manifest()
+            # the manifest is only correct again once everything is consolidated
+            consolidated.begin_update()
+            for cls in self._config.classes:
+                # only what is in the snapshot is consolidated and finalized,
+                # so anything collated meanwhile is left for next time
+                with stats.timer('consolidate: scan'):
+                    snapshot = ManifestSnapshot(cls, {host: self._collation_manifest(host) for host in self._config.collated_hosts(cls)})
+                try:
+                    if self._args.jobs > 1:
+                        self._consolidate_parallel(cls, snapshot)
                     else:
-                        append_and_set_timestamp(inpath, outpath)
-                        os.remove(inpath)
-                # remove all the directories, which should be empty now
-                # if not, it's because someone else is busy writing here,
-                # so ignore that for now, and we'll pick it up next time
+                        for relpath, entries in snapshot.relpaths():
+                            self._record_consolidated(cls, relpath, self._consolidate_relpath(cls, relpath, entries, self._consolidated_last(cls, relpath)))
+                    with stats.timer('consolidate: finalize'):
+                        self._finalize_consolidated(cls, snapshot)
+                finally:
+                    snapshot.close()
+            consolidated.end_update()
+        finally:
+            self._close_manifests()
+
+    def _consolidated_last(self, cls, relpath):
+        """Return the last timestamp in the consolidated file for relpath, or None if there is none."""
+        entry = self._consolidation_manifest().get(cls, 'ALL', relpath)
+        return entry.last if entry is not None and entry.last != '' else None
+
+    def _record_consolidated(self, cls, relpath, written):
+        """Record in the manifest what _merge_relpath wrote."""
+        appended, n_bytes, n_lines, last = written
+        if appended:
+            self._consolidation_manifest().append(cls, 'ALL', relpath, n_bytes, n_lines, last)
+        else:
+            self._consolidation_manifest().put(cls, 'ALL', relpath, n_bytes, n_lines, last)
+
+    def _consolidate_parallel(self, cls, snapshot):
+        """Consolidate relpaths on a pool of threads, returning only when all are done.
+
+        The manifest is only updated here on the main thread, as it can't be shared between threads."""
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._args.jobs) as executor:
+            # limit how far ahead we submit, to bound the memory used
+            pending = collections.deque()
+            try:
+                for relpath, entries in snapshot.relpaths():
+                    if len(pending) >= 2 * self._args.jobs:
+                        done, future = pending.popleft()
+                        self._record_consolidated(cls, done, future.result())
+                    last = self._consolidated_last(cls, relpath)
+                    pending.append((relpath, executor.submit(self._consolidate_relpath, cls, relpath, entries, last)))
+                while len(pending) > 0:
+                    done, future = pending.popleft()
+                    self._record_consolidated(cls, done, future.result())
+            finally:
+                for relpath, future in pending:
+                    future.cancel()
+
+    def _consolidate_relpath(self, cls, relpath, entries, last):
+        with stats.timer('consolidate: merge'):
+            return self._merge_relpath(cls, relpath, entries, last)
+
+    def _merge_relpath(self, cls, relpath, entries, last):
+        """Merge the files collated for relpath into the consolidated file,
+        whose last timestamp according to the manifest is last.
+
+        Of each collated file, only what its manifest entry has yet to be
+        consolidated is merged, exactly as _finalize_consolidated finalizes.
+        Returns whether they were appended, the number of bytes and lines
+        written, and the timestamp of the last line."""
+        krt = KeyedReaderHeap()
+        outpath = os.path.join(self._config.consolidation_dir(cls), relpath)
+        readers = [KeyedReader(os.path.join(self._config.host_collation_dir(cls, entry.host), relpath), self.__class__.timestamp, entry.consolidated, entry.size)
+                   for entry in entries]
+        if os.path.exists(outpath):
+            keys = [reader.key for reader in readers if reader.key is not None]
+            if last is not None and len(keys) > 0 and min(keys) >= last:
+                # every new line is at or after the existing ones, so simply append
+                for reader in readers:
+                    krt.insert(reader)
+                return (True,) + self._append_consolidated(krt, outpath, self._config.index_file(cls, relpath))
+            # inserted first, so that existing lines come before new ones with
+            # the same timestamp, as when appending
+            krt.insert(KeyedReader(outpath, self.__class__.timestamp))
+        for reader in readers:
+            krt.insert(reader)
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        outpathnew = '%s.new' % outpath
+        n_lines = 0
+        index = TimestampIndex()
+        with open_consolidated(outpathnew, 'w', self._config.consolidation_compression) as f:
+            for line in self._merged_lines(krt):
+                if n_lines % INDEX_INTERVAL == 0:
+                    index.add(self.__class__.timestamp(line), f.tell())
+                f.write(line)
+                n_lines += 1
+            n_bytes = f.tell()
+        os.rename(outpathnew, outpath)
+        index.set_file(os.stat(outpath))
+        index.save(self._config.index_file(cls, relpath))
+        stats.count('consolidate: files rewritten')
+        stats.count('consolidate: lines written', n_lines)
+        stats.count('consolidate: bytes written', n_bytes)
+        # set the timestamp according to the last key
+        t = timestamp_from_str(krt.lastkey).int_timestamp
+        os.utime(outpath, (t, t))
+        return False, n_bytes, n_lines, krt.lastkey
+
+    def _merged_lines(self, krt):
+        """Return the merged lines, compacted if asked."""
+        return compact_lines(krt.lines()) if self._args.compact else krt.lines()
+
+    def _append_consolidated(self, krt, outpath, indexpath):
+        index = TimestampIndex.load(indexpath)
+        if index is None or not index.covers(os.stat(outpath)):
+            # consolidated before there were indexes, or interrupted before indexing
+            index = TimestampIndex.build(outpath)
+        n_lines = 0
+        # appended to in whatever compression it already has
+        with open_consolidated(outpath, 'a', file_compression(outpath)) as f:
+            size = f.tell()
+            try:
+                for line in self._merged_lines(krt):
+                    if n_lines % INDEX_INTERVAL == 0:
+                        index.add(self.__class__.timestamp(line), f.tell())
+                    f.write(line)
+                    n_lines += 1
+            except:
+                # don't leave a partial append, which would be duplicated next time
+                f.truncate(size)
+                raise
+            n_bytes = f.tell() - size
+        stats.count('consolidate: files appended')
+        stats.count('consolidate: lines written', n_lines)
+        stats.count('consolidate: bytes written', n_bytes)
+        # set the timestamp according to the last key
+        t = timestamp_from_str(krt.lastkey).int_timestamp
+        os.utime(outpath, (t, t))
+        index.set_file(os.stat(outpath))
+        index.save(indexpath)
+        return n_bytes, n_lines, krt.lastkey
+
+    def export(self, classes):
+        """Append whatever has been consolidated since the last export to the export file for each class."""
+        # imported here, as pendulum is slow to import, and not needed by other commands
+        import pendulum
+        tz = pendulum.now().timezone
+        hours = {}
+        def seconds(timestamp):
+            # timestamps are like 20180312-16:54:38, and converting these is slow, so only do so per hour
+            hour = timestamp[:11]
+            if hour not in hours:
+                hours[hour] = pendulum.datetime(int(hour[:4]), int(hour[4:6]), int(hour[6:8]), int(hour[9:11]), tz=tz).int_timestamp
+            return hours[hour] + int(timestamp[12:14]) * 60 + int(timestamp[15:17])
+
+        def add(writer, line, path, inpath):
+            """Add the row or rows for a line, returning how many."""
+            try:
+                timestamp, host, user, args = line[:-1].decode('utf-8').split(' ', 3)
+                # expand any repeat count
+                timestamp, _, count = timestamp.partition('*')
+                count = int(count) if count else 1
+                for i in range(count):
+                    writer.add(seconds(timestamp), host, user, path, args)
+                return count
+            except (UnicodeDecodeError, ValueError):
+                sys.stderr.write('warning: not exporting badly formatted line in %s\n' % inpath)
+                return 0
+
+        try:
+            manifest = self._consolidation_manifest()
+            for cls in classes if len(classes) > 0 else self._config.classes:
+                writer = ExportWriter(self._config.export_file(cls))
+                # the files in the manifest, so not e.g. those left by an interrupted merge
+                for entry in manifest.files(cls, 'ALL'):
+                    inpath = os.path.join(self._config.consolidation_dir(cls), entry.relpath)
+                    path = '/' + entry.relpath
+                    st = os.stat(inpath)
+                    inode, offset = writer.progress.get(path, (None, 0))
+                    if inode == st.st_ino and offset == st.st_size:
+                        continue
+                    if inode is not None and (inode != st.st_ino or offset > st.st_size):
+                        # rewritten by consolidate rather than appended to, so export it afresh
+                        writer.reset(path)
+                        offset = 0
+                    if self._args.verbose:
+                        sys.stdout.write('exporting %s\n' % inpath)
+                    n_rows = 0
+                    compression = file_compression(inpath)
+                    with open(inpath, 'rb') as f:
+                        f.seek(offset)
+                        if compression is None:
+                            for line in read_lines(f):
+                                if not line.endswith(b'\n'):
+                                    break
+                                n_rows += add(writer, line, path, inpath)
+                                offset += len(line)
+                        else:
+                            # only whole members are read, which are of whole lines
+                            for start, offset, data in read_members(f, inpath, compression, st.st_size):
+                                for line in data.splitlines(keepends=True):
+                                    n_rows += add(writer, line, path, inpath)
+                    writer.set_progress(path, st.st_ino, offset)
+                    stats.count('export: files')
+                    stats.count('export: rows', n_rows)
+                    if len(writer) >= EXPORT_SEGMENT_ROWS:
+                        writer.flush()
+                writer.close()
+        finally:
+            self._close_manifests()
+
+    def query(self, pattern, classes=None, since=None, until=None, users=None, hosts=None):
+        """Print the consolidated lines for programs whose path matches the glob
+        pattern, each prefixed by the path.
+
+        If given, only lines timestamped at or after since and before until are
+        printed, and only those for the given users and hosts.  The sidecar
+        index of each file is used to start reading near since."""
+        since_b = since.encode('utf-8') if since is not None else None
+        until_b = until.encode('utf-8') if until is not None else None
+        users_b = set(user.encode('utf-8') for user in users) if users else None
+        hosts_b = set(host.encode('utf-8') for host in hosts) if hosts else None
+        out = sys.stdout.buffer
+        try:
+            manifest = self._consolidation_manifest()
+            for cls in classes if classes else self._config.classes:
+                for entry in manifest.files(cls, 'ALL'):
+                    path = '/' + entry.relpath
+                    if not fnmatch.fnmatchcase(path, pattern) or (since is not None and entry.last < since):
+                        continue
+                    inpath = os.path.join(self._config.consolidation_dir(cls), entry.relpath)
+                    offset = 0
+                    if since is not None:
+                        index = TimestampIndex.load(self._config.index_file(cls, entry.relpath))
+                        if index is not None and index.covers(os.stat(inpath)):
+                            offset = index.offset(since)
+                            stats.count('query: files seeked')
+                    prefix = path.encode('utf-8') + b' '
+                    n_lines = 0
+                    for line in read_consolidated(inpath, offset):
+                        n_lines += 1
+                        try:
+                            line, count = split_count_bytes(line)
+                        except ValueError:
+                            continue
+                        fields = line.split(b' ', 3)
+                        if len(fields) < 4:
+                            continue
+                        timestamp, host, user, args = fields
+                        if since_b is not None and timestamp < since_b:
+                            continue
+                        if until_b is not None and timestamp >= until_b:
+                            break
+                        if (users_b is None or user in users_b) and (hosts_b is None or host in hosts_b):
+                            out.write((prefix + line) * count)
+                    stats.count('query: files read')
+                    stats.count('query: lines read', n_lines)
+        finally:
+            self._close_manifests()
+        out.flush()
+
+    def _finalize_consolidated(self, cls, snapshot):
+        """Ensure the collated files in snapshot don't get consolidated again, by
+        moving them, or compressing them if consolidated files are compressed.
+
+        A collated file which has grown since the snapshot is still being
+        collated, so rather than being moved or cut short, it is left in place,
+        with only what was merged copied, and recorded as consolidated."""
+        consolidated = self._consolidation_manifest()
+        for host in snapshot.hosts:
+            self._collation_manifest(host).begin_update()
+        collationdirs = set(self._config.host_collation_dir(cls, host) for host in snapshot.hosts)
+        dirs = set(collationdirs)
+        mtimes = {}
+        for entry in snapshot.entries():
+            if entry.size <= entry.consolidated:
+                continue
+            manifest = self._collation_manifest(entry.host)
+            inpath = os.path.join(self._config.host_collation_dir(cls, entry.host), entry.relpath)
+            outpath = os.path.join(self._config.consolidation_dir(cls, entry.host), entry.relpath)
+            grown = os.path.getsize(inpath) > entry.size
+            n_bytes = entry.size - entry.consolidated
+            n_lines = entry.lines - entry.consolidated_lines
+            os.makedirs(os.path.dirname(outpath), exist_ok=True)
+            # appended to in whatever compression it already has
+            compression = file_compression(outpath) if os.path.exists(outpath) else self._config.consolidation_compression
+            # only a file consolidated whole and not growing may simply be moved
+            moved = compression is None and not grown and entry.consolidated == 0
+            if compression is not None:
+                mtimes[outpath], n_bytes = compress_file(inpath, outpath, compression, self._args.fsync, entry.consolidated, entry.size)
+                consolidated.append(cls, entry.host, entry.relpath, n_bytes, n_lines, entry.last)
+                stats.count('consolidate: files finalized by compression')
+            elif moved and move_or_append(inpath, outpath, mtimes, self._args.fsync):
+                consolidated.put(cls, entry.host, entry.relpath, entry.size, entry.lines, entry.last)
+                stats.count('consolidate: files finalized by rename')
+            else:
+                if not moved:
+                    mtimes[outpath] = append_file(inpath, outpath, self._args.fsync, entry.consolidated, entry.size)
+                consolidated.append(cls, entry.host, entry.relpath, n_bytes, n_lines, entry.last)
+                stats.count('consolidate: files finalized by append')
+            if grown:
+                if entry.last:
+                    # as for the collated file, the time of the last line finalized
+                    mtimes[outpath] = timestamp_from_str(entry.last).int_timestamp
+                manifest.set_consolidated(cls, entry.host, entry.relpath, entry.size, entry.lines)
+                stats.count('consolidate: files finalized in part')
+            else:
+                if not moved:
+                    os.remove(inpath)
+                manifest.remove(cls, entry.host, entry.relpath)
+                dirs.add(os.path.dirname(inpath))
+        set_timestamps(mtimes)
+        for host in snapshot.hosts:
+            self._collation_manifest(host).end_update()
+        # remove all the directories, which should be empty now
+        # if not, it's because someone else is busy writing here,
+        # so ignore that for now, and we'll pick it up next time
+        for dirpath in sorted(dirs, key=len, reverse=True):
+            while True:
                 try:
-                    os.rmdir(root)
+                    os.rmdir(dirpath)
                 except OSError:
-                    pass
+                    break
+                if dirpath in collationdirs:
+                    break
+                dirpath = os.path.dirname(dirpath)
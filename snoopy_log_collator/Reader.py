@@ -13,59 +13,213 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import gzip
+import concurrent.futures
 import os
-import pendulum
-import re
+import queue
 import sys
+import threading
+import time
 
-def get_tagged_fields(s):
-    """Extract tagged snoopy fields as a dict."""
-    # Alas embedded spaces cause difficulty, as snoopy doesn't quote them in the logfile.
-    # We therefore split on a cunning regex
-    cunningRE = re.compile(r"""(\s+[a-z]+:)""")
-    cunningSplit = re.split(cunningRE, s)
-    toks = cunningSplit[0].split(':', 1) + cunningSplit[1:]
-    fields = {}
-    for i in range(len(toks) // 2):
-        tag = toks[2 * i].lstrip().rstrip(':')
-        value = toks[2 * i + 1]
-        fields[tag] = value
-    if 'filename' not in fields:
-        sys.stderr.write("warning: get_tagged_fields failed to find filename for %s\n" % s)
-    return fields
+from .Decompression import open_logfile, read_lines
+from .LineParser import LineParser
+from .Stats import stats
+from .TimestampParser import TimestampParser
+
+# for pipelined collation, how many lines are passed between threads at a time,
+# how many such batches may be queued between each stage, and how many rpm and
+# yum queries may run at once
+PIPELINE_BATCH_SIZE = 1024
+PIPELINE_DEPTH = 8
+PREFETCH_THREADS = 4
+
+# how often a pipeline stage waiting on a queue checks whether to give up
+PIPELINE_POLL_INTERVAL = 0.1
+
+class _Failure(object):
+    """An exception raised in one pipeline stage, passed on to the next."""
+    def __init__(self, exception):
+        self.exception = exception
+
+# the last item passed between pipeline stages
+_END = object()
+
+def _batches(items, n):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def _put(q, item, stop):
+    """Put item on q, unless stop is set first, returning whether it was put."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=PIPELINE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _produce(items, q, stop):
+    """Put each of items on q, then _END, or a _Failure if an exception is raised, until stop is set."""
+    try:
+        for item in items:
+            if not _put(q, item, stop):
+                return
+        item = _END
+    except BaseException as e:
+        item = _Failure(e)
+    _put(q, item, stop)
+
+def _consume(q, stop):
+    """Yield the items from q put there by _produce, raising any exception passed on."""
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=PIPELINE_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        if isinstance(item, _Failure):
+            raise item.exception
+        yield item
 
 class Reader(object):
-    def __init__(self, log, logfile_dt, config):
+    def __init__(self, log, logfile_dt, config, external=False, pipeline=False):
+        """If external, decompress the logfile in an external program, where possible.
+        If pipeline, collate the logfile with collate_lines_pipelined."""
         self._config = config
+        self._external = external
+        self._pipeline = pipeline
         self._logfile_dt = logfile_dt
         self._logpath = os.path.join(self._config.logdir, log)
+        self._parser = LineParser(config.message_format)
+        self._timestamps = TimestampParser(logfile_dt)
+        self._loglineno = 0
 
-    def collate_to(self, collator):
-        loglineRE = re.compile(r"""^(\S+\s+\d+\s+\d+:\d+:\d+)\s+(\S+)\s+\S+\[(\d+)\]:\s+\[([^\]]*)\]:\s+(.*)$""")
-        logf = gzip.open(self._logpath)
-        loglineno = 0
+    def collate_to(self, collator, offset=0, checkpoint=None):
+        """Collate the logfile, starting from offset bytes into the uncompressed lines.
+
+        See collate_lines for checkpoint."""
+        logf = open_logfile(self._logpath, offset, self._external)
         try:
-            for logline_bytes in logf:
-                try:
-                    logline = logline_bytes.decode('utf-8')
-                    loglineno += 1
-                    m = loglineRE.match(logline)
-                    if m:
-                        # infer the year for the timestamp, which is usually the same as the logfile year,
-                        # except when we roll over from Dec to Jan
-                        timestamp_s = m.group(1)
-                        timestamp_year = self._logfile_dt.year - 1 if timestamp_s.startswith('Dec') and self._logfile_dt.month == 1 else self._logfile_dt.year
-                        timestamp = pendulum.parse('%d %s' % (timestamp_year, timestamp_s), tz=pendulum.now().timezone, strict=False)
-                        fields = get_tagged_fields(m.group(4))
-                        command = m.group(5).rstrip()
-                        collator.command(timestamp, fields, command)
-                    else:
-                        sys.stderr.write('warning: ignoring badly formatted line at %s:%d\n' % (self._logpath, loglineno))
-                except UnicodeDecodeError:
-                    sys.stderr.write('warning: ignoring badly encoded line at %s:%d\n' % (self._logpath, loglineno))
+            loglines = stats.timed('collate: decompress', read_lines(logf))
+            if self._pipeline:
+                return self.collate_lines_pipelined(loglines, collator, offset, checkpoint)
+            else:
+                return self.collate_lines(loglines, collator, offset, checkpoint)
+        finally:
+            logf.close()
+
+    def collate_lines(self, loglines, collator, offset=0, checkpoint=None):
+        """Collate loglines, which are bytes starting at offset in the logfile,
+        continuing the line numbering of any previous lines.
+
+        Whenever the collator is full, it is flushed, and then checkpoint, if
+        given, is called with the offset of the lines written.  Returns the
+        offset of the end of the lines, which the caller should flush."""
+        return self._write(self._parse(loglines, self._loglineno), collator, offset, checkpoint)
+
+    def collate_lines_pipelined(self, loglines, collator, offset=0, checkpoint=None):
+        """As collate_lines, but with decompression, parsing, and writing the
+        lines each in a separate thread, connected by bounded queues, so that
+        each stage need not wait while the others run.
+
+        Before each batch of lines is written, the rpm and yum queries for the
+        next batch are started on a small pool of threads.  The lines are
+        written in the same order as by collate_lines, by the calling thread."""
+        stop = threading.Event()
+        batches = queue.Queue(PIPELINE_DEPTH)
+        records = queue.Queue(PIPELINE_DEPTH)
+        threads = [
+            threading.Thread(target=_produce, args=(_batches(loglines, PIPELINE_BATCH_SIZE), batches, stop), name='decompress'),
+            threading.Thread(target=_produce, args=(self._parse_batches(_consume(batches, stop)), records, stop), name='parse'),
+        ]
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_THREADS)
+        for thread in threads:
+            thread.start()
+        try:
+            return self._write(self._prefetched(_consume(records, stop), collator, executor), collator, offset, checkpoint)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            collator.end_prefetch()
+            executor.shutdown()
+
+    def _parse_batches(self, batches):
+        loglineno = self._loglineno
+        for batch in batches:
+            records = list(self._parse(batch, loglineno))
+            loglineno = records[-1][1]
+            yield records
+
+    @staticmethod
+    def _prefetched(batches, collator, executor):
+        """Yield the records of each batch, once those of the following batch have been prefetched."""
+        previous = []
+        for batch in batches:
+            for n_bytes, loglineno, parsed in batch:
+                if parsed is not None:
+                    collator.prefetch(parsed[1], executor)
+            yield from previous
+            previous = batch
+        yield from previous
+
+    def _parse(self, loglines, loglineno):
+        """Yield, for each of loglines, its length, line number, and the
+        arguments for Collator.command, or None if it is rejected, numbering
+        the lines after loglineno."""
+        parse = self._parser.parse
+        timestamps = self._timestamps
+        timing = stats.enabled
+        for logline_bytes in loglines:
+            if timing:
+                start = time.perf_counter()
+            parsed = None
+            loglineno += 1
+            try:
+                extracted = parse(logline_bytes)
+                if extracted is not None:
+                    syslog_timestamp, fields, command = extracted
+                    timestamp, timestamp_s = timestamps.parse(syslog_timestamp)
+                    if timing:
+                        stats.add_time('collate: parse', time.perf_counter() - start)
+                    parsed = (timestamp, fields, command, timestamp_s)
+                else:
+                    sys.stderr.write('warning: ignoring badly formatted line at %s:%d\n' % (self._logpath, loglineno))
+            except UnicodeDecodeError:
+                sys.stderr.write('warning: ignoring badly encoded line at %s:%d\n' % (self._logpath, loglineno))
+            except ValueError as e:
+                sys.stderr.write('warning: ignoring line at %s:%d with %s\n' % (self._logpath, loglineno, e))
+            yield len(logline_bytes), loglineno, parsed
+
+    def _write(self, records, collator, offset, checkpoint):
+        """Collate records from _parse, as for collate_lines."""
+        loglineno = self._loglineno
+        n_read = 0
+        n_rejected = 0
+        try:
+            for n_bytes, loglineno, parsed in records:
+                n_read += 1
+                if parsed is not None:
+                    collator.command(*parsed)
+                else:
+                    n_rejected += 1
+                offset += n_bytes
+                if collator.full:
+                    collator.flush()
+                    if checkpoint is not None:
+                        checkpoint(offset)
         except:
             sys.stderr.write('failed at %s:%d\n' % (self._logpath, loglineno))
             raise
         finally:
-            logf.close()
+            self._loglineno = loglineno
+            stats.count('collate: lines read', n_read)
+            stats.count('collate: lines rejected', n_rejected)
+            stats.count('collate: lines parsed', n_read - n_rejected)
+        return offset
@@ -13,46 +13,145 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
 import os
 import os.path
 import pendulum
 import re
+import shutil
+import signal
 import sys
+import tempfile
+import time
 
 from .Collator import Collator
 from .Config import Config
+from .Decompression import compression_suffix, open_logfile
+from .FollowCheckpoint import FollowCheckpoint, HEAD_SIZE
+from .Journal import Journal, file_sizes
+from .Manifest import open_collation_manifest
 from .Mapper import Mapper
+from .MapperCache import open_mapper_cache, rpmdb_fingerprint
 from .Reader import Reader
+from .Stats import stats
+from .util import bare_hostname, move_or_append, set_timestamps, write_file_atomically
+
+# how much of the active logfile to collate at a time in follow mode
+FOLLOW_BATCH_SIZE = 1048576
+
+def collate_to_spool(args, entry, logfile_dt, offset, spooldir):
+    """Collate a single logfile into spooldir, in a worker process.
+
+    Returns what was collated, for the main process to record in the
+    Manifest, and the stats for this logfile.  The Mapper cache is written
+    through, so that the workers share their lookups rather than repeating them."""
+    stats.enabled = args.stats is not None
+    stats.reset()
+    config = Config(args)
+    mapper = Mapper(open_mapper_cache(config, write_through=True), bulk=args.bulk)
+    try:
+        collator = Collator(config, mapper, spooldir, compact=args.compact)
+        Reader(entry, logfile_dt, config, args.external_decompression, args.pipeline).collate_to(collator, offset)
+        collator.flush()
+    finally:
+        mapper.close()
+    return collator.take_appended(), stats.as_dict()
 
 class Scanner(object):
 
     def __init__(self, args):
         self._args = args
         self._config = Config(args)
-        self._mapper = Mapper()
-        self._collator = Collator(self._config, self._mapper)
+        self._journal = Journal(self._config.journal_file)
+        self._manifest = open_collation_manifest(self._config, bare_hostname(), args.rebuild_manifest)
+        self._open_mapper()
+
+    def _open_mapper(self):
+        self._rpmdb_fingerprint = rpmdb_fingerprint()
+        self._mapper = Mapper(open_mapper_cache(self._config), bulk=self._args.bulk)
+        self._collator = Collator(self._config, self._mapper, journal=self._journal, manifest=self._manifest, compact=self._args.compact)
 
     def _get_last_collation(self):
-        timestampRE = re.compile(r"""^(\d\d\d\d)(\d\d)(\d\d)$""")
+        """Return the date of the last logfile collated, and if that was only
+        partly collated, the offset reached in it, otherwise None."""
+        timestampRE = re.compile(r"""^(\d\d\d\d)(\d\d)(\d\d)(?: (\d+))?$""")
         try:
             with open(self._config.last_collation_file) as f:
                 m = timestampRE.match(f.read())
                 if m:
-                    return pendulum.DateTime(int(m.group(1)), int(m.group(2)), int(m.group(3)), tzinfo=pendulum.now().timezone)
-            return None
+                    dt = pendulum.DateTime(int(m.group(1)), int(m.group(2)), int(m.group(3)), tzinfo=pendulum.now().timezone)
+                    return dt, int(m.group(4)) if m.group(4) is not None else None
+            return None, None
         except (IOError, ValueError):
-            return None
+            return None, None
+
+    def _set_last_collation(self, dt, offset=None):
+        """Record the logfile for dt as collated, or if offset is given, as collated only that far."""
+        if offset is None:
+            s = '%s\n' % dt.strftime('%Y%m%d')
+        else:
+            s = '%s %d\n' % (dt.strftime('%Y%m%d'), offset)
+        write_file_atomically(self._config.last_collation_file, s)
 
-    def _set_last_collation(self, dt):
-        with open(self._config.last_collation_file, 'w') as f:
-            f.write('%s\n' % dt.strftime('%Y%m%d'))
+    def _recover(self):
+        """Undo any interrupted appends, and correct the Manifest for them."""
+        for path in self._journal.recover():
+            for cls in self._config.classes_with_all:
+                collationdir = self._config.localhost_collation_dir(cls)
+                if path.startswith(collationdir + os.sep):
+                    self._manifest.refresh(cls, bare_hostname(), path[len(collationdir) + 1:], path)
+        self._manifest.commit()
 
     def scan(self):
-        last_collation_dt = self._get_last_collation()
+        try:
+            self._recover()
+            self._scan()
+            self._journal.clear()
+        finally:
+            self._mapper.close()
+            self._manifest.close()
+        if self._args.verbose:
+            self._mapper.write_stats(sys.stdout)
+
+    def follow(self):
+        """Collate rotated logfiles as for scan, then the active logfile as it
+        grows, checking every interval seconds until interrupted or terminated."""
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            self._recover()
+            first = True
+            while True:
+                if rpmdb_fingerprint() != self._rpmdb_fingerprint:
+                    # packages have changed, so start again with the Mapper
+                    self._mapper.close()
+                    self._open_mapper()
+                self._scan(verbose_skips=first)
+                self._follow()
+                first = False
+                self._mapper.commit_cache()
+                time.sleep(self._args.interval)
+        except KeyboardInterrupt:
+            # the journal is kept, in case this interrupted a flush
+            pass
+        finally:
+            self._mapper.close()
+            self._manifest.close()
+        if self._args.verbose:
+            self._mapper.write_stats(sys.stdout)
+
+    def _logfile_head(self, entry):
+        with open_logfile(os.path.join(self._config.logdir, entry)) as f:
+            return f.read(HEAD_SIZE)
+
+    def _scan(self, verbose_skips=True):
+        last_collation_dt, last_collation_offset = self._get_last_collation()
+        checkpoint = FollowCheckpoint(self._config.follow_checkpoint_file)
 
         # important to process logfiles in order, so timestamps are preserved
+        logfiles = []
         for entry in sorted(os.listdir(self._config.logdir)):
-            snoopyLogRE = re.compile(r"""^snoopy-(\d\d\d\d)(\d\d)(\d\d).gz$""")
+            snoopyLogRE = re.compile(r"""^snoopy-(\d\d\d\d)(\d\d)(\d\d)(\.gz|\.bz2|\.xz|\.zst)?$""")
             m = snoopyLogRE.match(entry)
             if m:
                 logfile_year = int(m.group(1))
@@ -60,12 +159,158 @@ class Scanner(object):
                 logfile_day = int(m.group(3))
                 logfile_dt = pendulum.DateTime(logfile_year, logfile_month, logfile_day, tzinfo=pendulum.now().timezone)
                 if last_collation_dt is None or last_collation_dt < logfile_dt:
-                    reader = Reader(entry, logfile_dt, self._config)
-                    if self._args.verbose:
-                        sys.stdout.write('collating %s\n' % entry)
-                    reader.collate_to(self._collator)
+                    offset = 0
+                elif last_collation_dt == logfile_dt and last_collation_offset is not None:
+                    # resume where a previous run was interrupted
+                    offset = last_collation_offset
+                else:
+                    offset = None
+                if offset is not None:
+                    # skip what was collated in follow mode before the logfile was rotated
+                    record = checkpoint.find_head(self._logfile_head(entry)) if len(checkpoint.records) > 0 else None
+                    if record is not None:
+                        offset = max(offset, record.offset)
+                    logfiles.append((entry, logfile_dt, offset, record))
                     last_collation_dt = logfile_dt
-                    self._set_last_collation(last_collation_dt)
+                    last_collation_offset = None
                 else:
-                    if self._args.verbose:
+                    if self._args.verbose and verbose_skips:
                         sys.stdout.write('skipping %s\n' % entry)
+
+        if self._args.jobs > 1 and len(logfiles) > 1:
+            self._collate_parallel(logfiles, checkpoint)
+        else:
+            self._journal.guard(self._config.last_collation_file)
+            for entry, logfile_dt, offset, record in logfiles:
+                stats.count('collate: logfiles')
+                reader = Reader(entry, logfile_dt, self._config, self._args.external_decompression, self._args.pipeline)
+                if self._args.verbose:
+                    if offset > 0:
+                        sys.stdout.write('collating %s from %d\n' % (entry, offset))
+                    else:
+                        sys.stdout.write('collating %s\n' % entry)
+                reader.collate_to(self._collator, offset, lambda offset: self._set_last_collation(logfile_dt, offset))
+                self._collator.flush()
+                self._set_last_collation(logfile_dt)
+                if record is not None:
+                    checkpoint.remove(record)
+
+    def _follow(self):
+        """Collate the complete lines added to the active logfile since last time.
+
+        Once the active logfile has been rotated, it is finished off under its
+        new name if that is still uncompressed, otherwise by _scan once it
+        has been compressed.  Either way, the new active logfile is not
+        started until then, so that lines are collated in order."""
+        checkpoint = FollowCheckpoint(self._config.follow_checkpoint_file)
+        try:
+            st = os.stat(os.path.join(self._config.logdir, self._config.active_log))
+        except FileNotFoundError:
+            return
+        self._journal.guard(self._config.follow_checkpoint_file)
+        active = None
+        renamed = None
+        for record in list(checkpoint.records):
+            if record.inode == st.st_ino and st.st_size >= record.offset and self._plain_head(self._config.active_log, len(record.head)) == record.head:
+                active = record
+                break
+            if renamed is None:
+                renamed = {e.inode(): e.name for e in os.scandir(self._config.logdir) if e.is_file() and compression_suffix(e.name) == ''}
+            if record.inode not in renamed or renamed[record.inode] == self._config.active_log or self._plain_head(renamed[record.inode], len(record.head)) != record.head:
+                if self._args.verbose:
+                    sys.stdout.write('waiting for rotated logfile to be compressed\n')
+                return
+            self._follow_logfile(renamed[record.inode], record, checkpoint)
+        self._follow_logfile(self._config.active_log, active, checkpoint)
+
+    def _plain_head(self, entry, n):
+        with open(os.path.join(self._config.logdir, entry), 'rb') as f:
+            return f.read(n)
+
+    def _follow_logfile(self, entry, record, checkpoint):
+        """Collate the complete lines of an uncompressed logfile beyond its checkpoint record,
+        adding a record if there is none."""
+        def set_offset(offset):
+            record.offset = offset
+            checkpoint.save()
+
+        reader = Reader(entry, pendulum.now(), self._config)
+        with open(os.path.join(self._config.logdir, entry), 'rb') as f:
+            if record is not None:
+                f.seek(record.offset)
+            while True:
+                lines = f.readlines(FOLLOW_BATCH_SIZE)
+                incomplete = len(lines) > 0 and not lines[-1].endswith(b'\n')
+                if incomplete:
+                    # still being written, so leave it for next time
+                    lines.pop()
+                if len(lines) == 0:
+                    break
+                if record is None:
+                    record = checkpoint.add(os.fstat(f.fileno()).st_ino, lines[0])
+                if self._args.verbose:
+                    sys.stdout.write('collating %s from %d\n' % (entry, record.offset))
+                offset = reader.collate_lines(lines, self._collator, record.offset, set_offset)
+                self._collator.flush()
+                set_offset(offset)
+                if incomplete:
+                    break
+
+    def _collate_parallel(self, logfiles, checkpoint):
+        """Collate logfiles into separate spools in worker processes, merging
+        each spool in turn into the collation-dir, in logfile order."""
+        spoolroot = os.path.dirname(self._config.last_collation_file)
+        os.makedirs(spoolroot, exist_ok=True)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=self._args.jobs)
+        # limit how far ahead the workers get, to bound the space used by spools
+        pending = collections.deque()
+        todo = collections.deque(logfiles)
+        try:
+            while len(todo) > 0 or len(pending) > 0:
+                while len(todo) > 0 and len(pending) < 2 * self._args.jobs:
+                    entry, logfile_dt, offset, record = todo.popleft()
+                    spooldir = tempfile.mkdtemp(prefix='.%s.spool-' % bare_hostname(), dir=spoolroot)
+                    future = executor.submit(collate_to_spool, self._args, entry, logfile_dt, offset, spooldir)
+                    pending.append((entry, logfile_dt, record, spooldir, future))
+                entry, logfile_dt, record, spooldir, future = pending[0]
+                appended, worker_stats = future.result()
+                stats.update(worker_stats)
+                stats.count('collate: logfiles')
+                if self._args.verbose:
+                    sys.stdout.write('collating %s\n' % entry)
+                with stats.timer('collate: merge spools'):
+                    self._merge_spool(spooldir, appended)
+                pending.popleft()
+                self._set_last_collation(logfile_dt)
+                if record is not None:
+                    checkpoint.remove(record)
+        finally:
+            # not shutdown's cancel_futures, which is only in Python 3.9 onwards
+            for entry, logfile_dt, record, spooldir, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for entry, logfile_dt, record, spooldir, future in pending:
+                shutil.rmtree(spooldir, ignore_errors=True)
+
+    def _merge_spool(self, spooldir, appended):
+        """Append the files collated in spooldir to the collation-dir, recording
+        what was appended in the Manifest, and remove spooldir."""
+        paths = []
+        for cls in self._config.classes_with_all:
+            clsdir = os.path.join(spooldir, cls)
+            n = len(clsdir) + 1
+            for root, dirs, files in os.walk(clsdir):
+                for filename in sorted(files):
+                    inpath = os.path.join(root, filename)
+                    paths.append((inpath, os.path.join(self._config.localhost_collation_dir(cls), inpath[n:])))
+        self._journal.guard(self._config.last_collation_file)
+        self._journal.record(file_sizes(outpath for inpath, outpath in paths))
+        mtimes = {}
+        for inpath, outpath in paths:
+            os.makedirs(os.path.dirname(outpath), exist_ok=True)
+            move_or_append(inpath, outpath, mtimes, self._args.fsync)
+        set_timestamps(mtimes)
+        for cls, relpath, n_bytes, n_lines, last in appended:
+            self._manifest.append(cls, bare_hostname(), relpath, n_bytes, n_lines, last)
+        self._manifest.commit()
+        shutil.rmtree(spooldir)
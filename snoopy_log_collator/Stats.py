@@ -0,0 +1,105 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import threading
+import time
+
+class Stats(object):
+    """Stats are the counters and stage timings for a run, reported with --stats.
+
+    Counting is always cheap, but timing is only done when enabled, and code
+    in inner loops should check enabled before timing anything."""
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = collections.Counter()
+        self.seconds = collections.Counter()
+        # consolidation may run on several threads
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.seconds.clear()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.seconds[name] += seconds
+
+    def timer(self, name):
+        """Return a context manager timing its body as the stage name."""
+        return Timer(self, name)
+
+    def timed(self, name, iterable):
+        """Iterate over iterable, timing the production of each item as the stage name."""
+        if self.enabled:
+            return self._timed(name, iterable)
+        else:
+            return iterable
+
+    def _timed(self, name, iterable):
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    def as_dict(self):
+        return {'counters': dict(self.counters), 'seconds': dict(self.seconds)}
+
+    def update(self, d):
+        """Add in stats from as_dict, e.g. from a worker process."""
+        with self._lock:
+            self.counters.update(d['counters'])
+            self.seconds.update(d['seconds'])
+
+    def write(self, f, format='text'):
+        if format == 'json':
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+            f.write('\n')
+        else:
+            for name in sorted(self.seconds):
+                f.write('%-40s %12.3fs\n' % (name, self.seconds[name]))
+            for name in sorted(self.counters):
+                f.write('%-40s %12d\n' % (name, self.counters[name]))
+
+class Timer(object):
+
+    def __init__(self, stats, name):
+        self._stats = stats
+        self._name = name
+
+    def __enter__(self):
+        if self._stats.enabled:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self._stats.enabled:
+            self._stats.add_time(self._name, time.perf_counter() - self._start)
+
+# the stats for this process
+stats = Stats()
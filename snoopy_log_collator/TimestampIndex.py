@@ -0,0 +1,114 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import os
+import os.path
+import sys
+
+from .Compression import file_compression, read_members
+from .Decompression import read_lines
+from .util import line_timestamp, write_file_atomically
+
+# how many lines of a consolidated file there are per index entry
+INDEX_INTERVAL = 1024
+
+class TimestampIndex(object):
+    """A TimestampIndex is a sparse index of a consolidated file, with the
+    timestamp and offset of every INDEX_INTERVAL lines, so that the lines from
+    some time onwards may be found without reading the whole file.
+
+    It is saved in a sidecar file, with the inode and size of the file indexed.
+    As consolidated files are only appended to or replaced, the index remains
+    correct for as long as the inode is the same and the file no smaller,
+    though lines appended since are not indexed."""
+
+    def __init__(self):
+        self.inode = None
+        self.size = 0
+        self.timestamps = []
+        self.offsets = []
+
+    @classmethod
+    def load(cls, path):
+        """Return the index saved at path, or None if there is none."""
+        index = cls()
+        try:
+            with open(path) as f:
+                inode, size = f.readline().split()
+                index.inode = int(inode)
+                index.size = int(size)
+                for line in f:
+                    timestamp, offset = line.split()
+                    index.add(timestamp, int(offset))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            sys.stderr.write('warning: ignoring badly formatted index %s\n' % path)
+            return None
+        return index
+
+    @classmethod
+    def build(cls, path):
+        """Index the file at path by reading all of it.
+
+        A compressed file may only be read from the start of a member, so it is
+        indexed at the first member after every INDEX_INTERVAL lines."""
+        index = cls()
+        compression = file_compression(path)
+        with open(path, 'rb') as f:
+            if compression is None:
+                offset = 0
+                for i, line in enumerate(read_lines(f)):
+                    if i % INDEX_INTERVAL == 0:
+                        index._add_line(line, offset)
+                    offset += len(line)
+            else:
+                n_lines = 0
+                for start, end, data in read_members(f, path, compression):
+                    if len(data) > 0 and (len(index.offsets) == 0 or n_lines >= INDEX_INTERVAL):
+                        index._add_line(data, start)
+                        n_lines = 0
+                    n_lines += data.count(b'\n')
+            index.set_file(os.fstat(f.fileno()))
+        return index
+
+    def _add_line(self, line, offset):
+        self.add(line_timestamp(line).decode('utf-8', errors='replace'), offset)
+
+    def covers(self, st):
+        """Whether the index is correct for the file whose stat is st."""
+        return self.inode == st.st_ino and self.size <= st.st_size
+
+    def add(self, timestamp, offset):
+        self.timestamps.append(timestamp)
+        self.offsets.append(offset)
+
+    def set_file(self, st):
+        """Record the file indexed, once it has been written."""
+        self.inode = st.st_ino
+        self.size = st.st_size
+
+    def offset(self, since):
+        """Return an offset at or before the first line whose timestamp is at or after since."""
+        i = bisect.bisect_left(self.timestamps, since)
+        return self.offsets[i - 1] if i > 0 else 0
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lines = ['%d %d\n' % (self.inode, self.size)]
+        lines.extend('%s %d\n' % entry for entry in zip(self.timestamps, self.offsets))
+        # not synced, as an index lost in a crash is simply rebuilt
+        write_file_atomically(path, ''.join(lines), fsync=False)
@@ -0,0 +1,60 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pendulum
+
+from .util import timestamp_str
+
+MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+class TimestampParser(object):
+    """A TimestampParser converts the syslog timestamps of a single logfile,
+    which look like 'Mar 12 16:54:38', and have no year or timezone.
+
+    Snoopy writes many lines in the same second, so conversions are memoized
+    on the timestamp string."""
+
+    def __init__(self, logfile_dt):
+        self._logfile_dt = logfile_dt
+        self._tz = pendulum.now().timezone
+        self._parsed = {}
+
+    def parse(self, s):
+        """Return the DateTime and the collated timestamp string for s.
+
+        Raises ValueError if s is not a syslog timestamp."""
+        try:
+            return self._parsed[s]
+        except KeyError:
+            pass
+        try:
+            month_s, day_s, time_s = s.split()
+            hour_s, minute_s, second_s = time_s.split(':')
+            month = MONTHS[month_s]
+        except (KeyError, ValueError):
+            raise ValueError('bad syslog timestamp %s' % s)
+        # infer the year for the timestamp, which is usually the same as the logfile year,
+        # except when we roll over from Dec to Jan
+        year = self._logfile_dt.year - 1 if month == 12 and self._logfile_dt.month == 1 else self._logfile_dt.year
+        try:
+            dt = pendulum.datetime(year, month, int(day_s), int(hour_s), int(minute_s), int(second_s), tz=self._tz)
+        except ValueError:
+            raise ValueError('impossible syslog timestamp %s' % s)
+        parsed = (dt, timestamp_str(dt))
+        self._parsed[s] = parsed
+        return parsed
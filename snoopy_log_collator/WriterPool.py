@@ -0,0 +1,91 @@
+# Copyright (c) 2018 Simon Guest
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+
+from .Journal import file_sizes
+from .Stats import stats
+from .util import compact_lines, line_timestamp
+
+class WriterPool(object):
+    """A WriterPool appends lines to many output files, buffering the lines for
+    each file, so that each file is opened just once per flush.
+
+    No file is held open between flushes, so that once flushed, a file may be
+    moved or removed, e.g. by consolidation, and is then written afresh by the
+    next flush.  The modification time of each file is set once per flush, to
+    the timestamp of the last line written there.
+
+    It is for the caller to flush when full, so that flushes happen at
+    points where the caller can record its progress.  If a Journal is given,
+    the sizes of the files are recorded there before each flush.  If compact,
+    each run of identical lines in a flush is written as a single line with a
+    repeat count."""
+
+    def __init__(self, max_buffered=65536, journal=None, compact=False):
+        self._journal = journal
+        self._compact = compact
+        self._max_buffered = max_buffered
+        self._buffers = {}
+        self._mtimes = {}
+        self._n_buffered = 0
+
+    def write(self, path, line, t):
+        """Append line to path, where t is the line's timestamp in seconds since the epoch."""
+        if path in self._buffers:
+            self._buffers[path].append(line)
+        else:
+            self._buffers[path] = [line]
+        self._mtimes[path] = t
+        self._n_buffered += 1
+
+    @property
+    def full(self):
+        return self._n_buffered >= self._max_buffered
+
+    def _open(self, path):
+        stats.count('collate: files opened')
+        # the directory mostly exists already, so only make it if that fails
+        try:
+            return open(path, 'ab')
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return open(path, 'ab')
+
+    def flush(self):
+        """Write out all buffered lines, closing each file, and set modification times.
+
+        Returns what was written to each path, as a dict of path to the number
+        of bytes, number of lines, and the timestamp string of the last line."""
+        written = {}
+        with stats.timer('collate: write'):
+            if self._journal is not None and len(self._buffers) > 0:
+                self._journal.record(file_sizes(self._buffers))
+            n_bytes = 0
+            for path, lines in self._buffers.items():
+                if self._compact:
+                    lines = list(compact_lines(lines))
+                with self._open(path) as f:
+                    n = f.write(''.join(lines).encode('utf-8'))
+                t = self._mtimes[path]
+                os.utime(path, (t, t))
+                written[path] = (n, len(lines), line_timestamp(lines[-1]))
+                n_bytes += n
+            stats.count('collate: bytes written', n_bytes)
+        self._buffers = {}
+        self._mtimes = {}
+        self._n_buffered = 0
+        return written
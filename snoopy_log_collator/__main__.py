@@ -16,45 +16,108 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import re
 import sys
 
-from snoopy_log_collator.Config import ConfigError
-from snoopy_log_collator.PostProcessor import PostProcessor
-from snoopy_log_collator.Scanner import Scanner
-from snoopy_log_collator.version import get_version
+from snoopy_log_collator.Stats import stats
+from snoopy_log_collator.UserError import UserError
 
-def main():
+# the modules for each command are imported only when it is run, so that
+# quick commands such as version and list-files start quickly
+
+def make_parser():
     parser = argparse.ArgumentParser(description='collate snoopy logfiles')
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
     parser.add_argument('-c', '--config', metavar='FILE', help='configuration file')
-    parser.add_argument('command', choices=['collate','consolidate','list-files','list-packages','list-excluded','purge-excluded','version'], help='command to run')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1, help='number of logfiles to collate, or files to consolidate, in parallel')
+    parser.add_argument('-b', '--bulk', action='store_true', help='query the rpm and yum databases in bulk, rather than once per program')
+    parser.add_argument('-x', '--external-decompression', action='store_true', help='decompress logfiles with an external program such as pigz or zstd, in parallel with collation')
+    parser.add_argument('-p', '--pipeline', action='store_true', help='for collate, decompress, parse, and write each logfile in separate threads, and look up programs in advance')
+    parser.add_argument('-f', '--follow', action='store_true', help='for collate, keep collating the active logfile as it grows, until interrupted')
+    parser.add_argument('--interval', metavar='SECONDS', type=float, default=10.0, help='how often to check for new lines with --follow (default 10)')
+    parser.add_argument('--compact', action='store_true', help='write each run of identical lines as a single line with a repeat count, when collating and consolidating')
+    parser.add_argument('--fsync', action='store_true', help='fsync files appended to when merging spools and finalizing consolidation')
+    parser.add_argument('--rebuild-manifest', action='store_true', help='rebuild the manifests of collated and consolidated files by walking the directories')
+    parser.add_argument('--stats', action='store_const', const='text', help='report counters and timings at the end of the run')
+    parser.add_argument('--stats-json', action='store_const', dest='stats', const='json', help='as --stats, but report as JSON')
+    parser.add_argument('--profile', metavar='FILE', help='write cProfile stats for the command to FILE')
+    parser.add_argument('command', choices=['collate','consolidate','list-files','list-packages','list-excluded','purge-excluded','export','query','version'], help='command to run')
     parser.add_argument('args', nargs=argparse.REMAINDER, help='command arguments')
-    args = parser.parse_args()
+    return parser
 
-    try:
-        if args.command == 'version':
-            print('snoopy-log-collator v%s' % get_version())
-        elif args.command == 'list-files':
-            p = PostProcessor(args)
-            p.list_files(args.args)
-        elif args.command == 'list-packages':
-            p = PostProcessor(args)
-            p.list_packages(args.args)
-        elif args.command == 'list-excluded':
-            p = PostProcessor(args)
-            p.list_excluded(args.args)
-        elif args.command == 'purge-excluded':
-            p = PostProcessor(args)
-            p.list_excluded(args.args, purge=True)
-        elif args.command == 'consolidate':
-            p = PostProcessor(args)
-            p.consolidate()
-        elif args.command == 'collate':
-            scanner = Scanner(args)
+def query_time(s):
+    if not re.match(r'^\d{8}(-\d\d:\d\d(:\d\d)?)?$', s):
+        raise argparse.ArgumentTypeError('invalid time %s, expected YYYYMMDD[-HH:MM[:SS]]' % s)
+    return s
+
+def make_query_parser():
+    parser = argparse.ArgumentParser(prog='snoopy-log-collator query', description='print the consolidated lines for programs matching PATTERN, each prefixed by the program path')
+    parser.add_argument('--since', metavar='TIME', type=query_time, help='only lines at or after TIME, as YYYYMMDD[-HH:MM[:SS]]')
+    parser.add_argument('--until', metavar='TIME', type=query_time, help='only lines before TIME')
+    parser.add_argument('-u', '--user', action='append', dest='users', metavar='USER', help='only lines for USER, which may be repeated')
+    parser.add_argument('-H', '--host', action='append', dest='hosts', metavar='HOST', help='only lines for HOST, which may be repeated')
+    parser.add_argument('-C', '--class', action='append', dest='classes', metavar='CLASS', help='query CLASS, which may be repeated, rather than all classes')
+    parser.add_argument('pattern', help='glob pattern for program paths, e.g. "/usr/bin/*"')
+    return parser
+
+def run(args):
+    if args.command == 'version':
+        from snoopy_log_collator.version import get_version
+        print('snoopy-log-collator v%s' % get_version())
+    elif args.command == 'collate':
+        from snoopy_log_collator.Scanner import Scanner
+        scanner = Scanner(args)
+        if args.follow:
+            scanner.follow()
+        else:
             scanner.scan()
-    except ConfigError as e:
+    else:
+        post_process(args)
+
+def post_process(args):
+    from snoopy_log_collator.PostProcessor import PostProcessor
+    if args.command == 'list-files':
+        p = PostProcessor(args)
+        p.list_files(args.args)
+    elif args.command == 'list-packages':
+        p = PostProcessor(args)
+        p.list_packages(args.args)
+    elif args.command == 'list-excluded':
+        p = PostProcessor(args)
+        p.list_excluded(args.args)
+    elif args.command == 'purge-excluded':
+        p = PostProcessor(args)
+        p.list_excluded(args.args, purge=True)
+    elif args.command == 'export':
+        p = PostProcessor(args)
+        p.export(args.args)
+    elif args.command == 'query':
+        q = make_query_parser().parse_args(args.args)
+        p = PostProcessor(args)
+        p.query(q.pattern, q.classes, q.since, q.until, q.users, q.hosts)
+    elif args.command == 'consolidate':
+        p = PostProcessor(args)
+        p.consolidate()
+
+def main():
+    args = make_parser().parse_args()
+    stats.enabled = args.stats is not None
+
+    try:
+        if args.profile is not None:
+            import cProfile
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(run, args)
+            finally:
+                profile.dump_stats(args.profile)
+        else:
+            run(args)
+    except UserError as e:
         sys.stderr.write('%s\n' % e)
         sys.exit(1)
+    if args.stats is not None:
+        stats.write(sys.stderr, args.stats)
 
 if __name__ == '__main__':
     main()
@@ -13,27 +13,173 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import os
-import pendulum
 
 def bare_hostname():
     """Hostname without domain."""
     return os.uname()[1].split('.')[0]
 
-def append_and_set_timestamp(inpath, outpath):
-    with open(inpath, 'r') as inf:
-        with open(outpath, 'a') as outf:
-            done = False
-            bufsize = 104857600 # 10MB at a time
-            bytes = inf.read(bufsize)
-            while bytes != '':
-                outf.write(bytes)
-                bytes = inf.read(bufsize)
-    t = os.stat(inpath).st_mtime
-    os.utime(outpath, (t, t))
+# how much to copy at a time when appending one file to another
+COPY_SIZE = 1048576
+
+def _copy_fd(infd, outfd, size=None):
+    """Copy the rest of infd to outfd, or only size bytes of it if given,
+    within the kernel if possible.
+
+    Neither may be opened for append, which copy_file_range doesn't support.
+    Where the kernel can't copy between these files, fall back to sendfile,
+    then to copying through a bounded buffer, continuing from wherever the
+    previous method got to."""
+    copied = 0
+    def todo():
+        return COPY_SIZE if size is None else min(COPY_SIZE, size - copied)
+    try:
+        while todo() > 0:
+            n = os.copy_file_range(infd, outfd, todo())
+            if n == 0:
+                break
+            copied += n
+        return
+    except (AttributeError, OSError):
+        pass
+    try:
+        while todo() > 0:
+            n = os.sendfile(outfd, infd, None, todo())
+            if n == 0:
+                break
+            copied += n
+        return
+    except (AttributeError, OSError):
+        pass
+    while todo() > 0:
+        data = os.read(infd, todo())
+        if len(data) == 0:
+            break
+        copied += len(data)
+        while len(data) > 0:
+            data = data[os.write(outfd, data):]
+
+def append_file(inpath, outpath, fsync=False, start=0, end=None):
+    """Append the contents of inpath from start, and only up to end if given,
+    to outpath, creating that if necessary, and return the modification time
+    of inpath, for set_timestamps."""
+    infd = os.open(inpath, os.O_RDONLY)
+    try:
+        outfd = os.open(outpath, os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            os.lseek(outfd, 0, os.SEEK_END)
+            os.lseek(infd, start, os.SEEK_SET)
+            _copy_fd(infd, outfd, None if end is None else end - start)
+            if fsync:
+                os.fsync(outfd)
+        finally:
+            os.close(outfd)
+        return os.fstat(infd).st_mtime
+    finally:
+        os.close(infd)
+
+def set_timestamps(mtimes):
+    """Set the modification time of files, from a dict of path to time, as returned by append_file."""
+    for path, t in mtimes.items():
+        os.utime(path, (t, t))
+
+def move_or_append(inpath, outpath, mtimes, fsync=False):
+    """Move inpath to outpath, by renaming it into place if outpath doesn't
+    exist and is on the same filesystem, otherwise by appending it and
+    removing inpath, returning whether it was renamed.
+
+    When appended, the modification time to set is added to mtimes, so
+    that these may be set together by set_timestamps once all are done."""
+    if not os.path.exists(outpath):
+        try:
+            os.rename(inpath, outpath)
+            return True
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    mtimes[outpath] = append_file(inpath, outpath, fsync)
+    os.remove(inpath)
+    return False
+
+def write_file_atomically(path, s, fsync=True):
+    """Replace the contents of a text file, so that no reader ever sees it
+    partly written, nor, if fsync, empty after a crash."""
+    tmppath = '%s.tmp' % path
+    with open(tmppath, 'w') as f:
+        f.write(s)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmppath, path)
+
+def last_line(path):
+    """Return the last line of a text file, reading back from the end, or '' if empty."""
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        blocksize = 4096
+        start = end
+        tail = b''
+        # we want the newline before the last line, not any which terminates it
+        while start > 0 and tail.count(b'\n', 0, len(tail) - 1) == 0:
+            start = max(0, start - blocksize)
+            f.seek(start)
+            tail = f.read(end - start)
+        i = tail.rfind(b'\n', 0, len(tail) - 1)
+        return tail[i + 1:].decode('utf-8')
 
 def timestamp_str(t0):
     return t0.strftime('%Y%m%d-%H:%M:%S')
 
 def timestamp_from_str(s):
+    # imported here, as pendulum is slow to import, and not needed by every command
+    import pendulum
     return pendulum.from_format(s, 'YYYYMMDD-HH:mm:ss', tz=pendulum.now().timezone)
+
+# the length of the timestamp at the start of each collated line, as written by timestamp_str
+TIMESTAMP_LEN = 17
+
+# In compact mode, a run of identical lines is written as a single line with
+# a repeat count after the timestamp, like this:
+#   20180313-12:57:50*3 invbfodp01 mccullocha /usr/bin/gunzip -c grep.1.gz
+# and everything which reads collated or consolidated files understands this.
+
+def line_timestamp(line):
+    """Return the timestamp of a collated line, str or bytes, without any repeat count."""
+    return line[:TIMESTAMP_LEN]
+
+def split_count(line):
+    """Return a collated line without any repeat count, and the count, which is 1 if there is none."""
+    if line[TIMESTAMP_LEN:TIMESTAMP_LEN + 1] != '*':
+        return line, 1
+    i = line.index(' ', TIMESTAMP_LEN)
+    return line[:TIMESTAMP_LEN] + line[i:], int(line[TIMESTAMP_LEN + 1:i])
+
+def split_count_bytes(line):
+    """As split_count, for a line read as bytes."""
+    if line[TIMESTAMP_LEN:TIMESTAMP_LEN + 1] != b'*':
+        return line, 1
+    i = line.index(b' ', TIMESTAMP_LEN)
+    return line[:TIMESTAMP_LEN] + line[i:], int(line[TIMESTAMP_LEN + 1:i])
+
+def with_count(line, n):
+    """Return line with the repeat count n, if that is more than 1."""
+    if n == 1:
+        return line
+    return '%s*%d%s' % (line[:TIMESTAMP_LEN], n, line[TIMESTAMP_LEN:])
+
+def compact_lines(lines):
+    """Yield lines with each run of identical lines, which may already have counts, as a single line with a count."""
+    prev = None
+    n = 0
+    for line in lines:
+        line, count = split_count(line)
+        if line == prev:
+            n += count
+        else:
+            if prev is not None:
+                yield with_count(prev, n)
+            prev = line
+            n = count
+    if prev is not None:
+        yield with_count(prev, n)
@@ -13,13 +13,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import pkg_resources
+import importlib.metadata
 
 def get_version():
     package = __name__.split('.', 1)[0]
     try:
-        version = pkg_resources.get_distribution(package).version
-    except pkg_resources.DistributionNotFound:
+        version = importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
         # package is not installed
         version = 'UNDEFINED'
     return version